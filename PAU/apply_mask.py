@@ -2,6 +2,71 @@
 from functions import *
 from astropy import wcs
 import argparse
+import hashlib
+
+class MaskEngine:
+	"""
+	WCS pixel masks, each opened once (memory-mapped) and applied to any number of catalogues/chunks:
+	a point is kept if it falls on a zero-valued (unmasked) pixel of any mask. With nside, the masks
+	are converted once to a sorted HEALPix lookup of unmasked pixels (cached beside the first mask),
+	so that testing points needs no WCS projection -- exact only to the nside resolution.
+	"""
+	def __init__(self, maskpaths, nside=None):
+		self.maskpaths = maskpaths
+		self.masks = []
+		for maskpath in maskpaths:
+			hdu = fits.open(maskpath, memmap=True)[0]
+			self.masks.append((hdu.data, wcs.WCS(hdu.header)))
+		self.nside = nside
+		if nside:
+			self.lookup = self.healpix_lookup(nside)
+
+	def keep_wcs(self, ra, dec):
+		# project points through every mask's WCS
+		radec = np.column_stack((ra, dec))
+		keep = np.zeros(len(radec), dtype=bool)
+		for mask, w in self.masks:
+			pixcrd = np.array(np.round(w.wcs_world2pix(radec, 0, ra_dec_order=1)), dtype=int)
+			inside = (pixcrd.T[1] >= 0) & (pixcrd.T[1] < mask.shape[0]) & (pixcrd.T[0] >= 0) & (pixcrd.T[0] < mask.shape[1])
+			keep[inside] |= mask[pixcrd[inside, 1], pixcrd[inside, 0]] == 0
+		return keep
+
+	def healpix_lookup(self, nside):
+		# sorted (ring) HEALPix pixels whose centres are unmasked -- built once per mask set & nside
+		key = '_'.join('%s%s%s'%(basename(m), os.stat(m).st_size, os.stat(m).st_mtime) for m in self.maskpaths)
+		table = '%s.healpix_nside%i_%s.npy'%(self.maskpaths[0], nside, hashlib.sha1(key.encode()).hexdigest()[:10])
+		if os.path.exists(table):
+			return np.load(table, mmap_mode='r')
+		print('converting masks to nside=%i HEALPix lookup..'%nside)
+		pix = []
+		for mask, w in self.masks:
+			# pixels covering the mask image
+			fra, fdec = w.calc_footprint().T
+			pix.append(hp.query_polygon(nside, hp.ang2vec(fra, fdec, lonlat=True), inclusive=True))
+		pix = np.unique(np.concatenate(pix))
+		pra, pdec = hp.pix2ang(nside, pix, lonlat=True)
+		lookup = pix[self.keep_wcs(pra, pdec)]
+		try:
+			np.save(table, lookup)
+		except (IOError, OSError):
+			print('cannot save HEALPix lookup beside mask -- rebuilding on every run')
+		return lookup
+
+	def keep(self, ra, dec, chunksize=2**22):
+		# True where (ra, dec) [deg] is unmasked, tested chunksize points at a time
+		keep = np.zeros(len(ra), dtype=bool)
+		for i in range(0, len(ra), chunksize):
+			ra_, dec_ = np.asarray(ra[i:i+chunksize]), np.asarray(dec[i:i+chunksize])
+			if self.nside:
+				if len(self.lookup) == 0:
+					continue # fully masked
+				pix = hp.ang2pix(self.nside, ra_, dec_, lonlat=True)
+				j = np.clip(np.searchsorted(self.lookup, pix), 0, len(self.lookup) - 1)
+				keep[i:i+chunksize] = self.lookup[j] == pix
+			else:
+				keep[i:i+chunksize] = self.keep_wcs(ra_, dec_)
+		return keep
+
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument(
@@ -13,28 +78,26 @@ if __name__ == '__main__':
 		nargs='*',
 		default=['W3.16bit.5arcs.reg2.fits'],
 		help='give path(s) to mask file(s)')
+	parser.add_argument(
+		'-nside',
+		type=int,
+		default=0,
+		help='test points against an nside HEALPix conversion of the masks (built once & cached), or 0 = project each point through the mask WCS (exact). Default=0')
+	parser.add_argument(
+		'-chunksize',
+		type=int,
+		default=2**22,
+		help='no. points tested at a time, default=2^22')
 	args = parser.parse_args()
 
+	engine = MaskEngine(args.mask, nside=args.nside)
 	for fname in args.fnames:
 
-		rand = fopen(fname)
-		rand_radec = np.column_stack((rand['ra'], rand['dec']))
-		cut = np.zeros_like(rand_radec.T[0], dtype=bool)
-
-		for maskpath in args.mask:
-			hdu = fits.open(maskpath)[0]
-			mask = hdu.data
-			w = wcs.WCS(hdu)
-			pixcrd = w.wcs_world2pix(rand_radec, 0, ra_dec_order=1)
-			pixcrd = np.array(np.round(pixcrd), dtype=int)
-			c1 = (pixcrd.T[1] >= 0) & (pixcrd.T[1] < mask.shape[0])
-			c0 = (pixcrd.T[0] >= 0) & (pixcrd.T[0] < mask.shape[1])
-			idx = np.where(c0 & c1)[0]
-			pixcrd_in_mask = pixcrd[c0 & c1]
-			vals_at_rand_radec = mask[pixcrd_in_mask[:,1], pixcrd_in_mask[:,0]] 
-			cut[idx] |= (vals_at_rand_radec == 0)
-
-		new_rand = rand[cut]
-		t = Table(new_rand)
-		t.write(fname, overwrite=1)
+		hdul = fits.open(fname, memmap=True)
+		rand = hdul[1].data
+		cut = engine.keep(rand['ra'], rand['dec'], chunksize=args.chunksize)
 
+		t = Table(rand[cut])
+		hdul.close()
+		t.write(fname, overwrite=1)
+		print('%s: kept %s / %s'%(fname, cut.sum(), len(cut)))
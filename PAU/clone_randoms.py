@@ -282,6 +282,49 @@ def get_tgauss_window(d, hilim, lolim, area=180., volume=3.5e6, V_base=None, zma
 	window_fn = np.stack((V_mid, window_fn))
 	return window_fn
 
+def draw_clone_volumes(n_clones, lolim_vol, hilim_vol, windows=None, V_base=None, chunksize=1024):
+	"""
+	Draw n_clones[i] volumes for every galaxy i at once -- uniformly within [lolim_vol, hilim_vol],
+	or, given windows (N galaxies x len(V_base)-1), by inverse-CDF sampling of each galaxy's window,
+	as a density in volume within its limits (windows taken as constant across each V_base bin),
+	chunksize galaxies at a time (their clones x len(V_base)-1 cdf rows held at once).
+	Returns drawn volumes and the index of the galaxy behind each; galaxies with empty windows get no clones.
+	"""
+	gal = np.repeat(np.arange(len(n_clones)), n_clones)
+	u = np.random.rand(len(gal))
+	if windows is None:
+		return lolim_vol[gal] + u * (hilim_vol - lolim_vol)[gal], gal
+
+	nbin = len(V_base) - 1
+	Vdraw = np.zeros(len(gal))
+	good = np.zeros(len(gal), dtype=bool)
+	starts = np.concatenate(([0], np.cumsum(n_clones)))
+	for i in range(0, len(n_clones), chunksize):
+		j = min(i + chunksize, len(n_clones))
+		c = slice(starts[i], starts[j])
+		if starts[i] == starts[j]:
+			continue
+		# window density x the volume of each bin inside the galaxy's limits -> probability per bin
+		vlo, vhi = lolim_vol[i:j, None], hilim_vol[i:j, None]
+		overlap = np.clip(V_base[1:], vlo, vhi) - np.clip(V_base[:-1], vlo, vhi)
+		w = np.asarray(windows[i:j], dtype=np.float64) * overlap
+		w[np.isnan(w)] = 0.
+		cdf = np.cumsum(w, axis=1)
+		tot = cdf[:, -1].copy()
+		cdf[tot > 0] /= tot[tot > 0, None]
+		# search each clone's own cdf row (first bin with cdf > u), kept within the galaxy's
+		# last bin of non-zero probability against rounding of the normalised cdf
+		g = gal[c] - i
+		b = (cdf[g] <= u[c, None]).sum(axis=1)
+		last = nbin - 1 - np.argmax(w[:, ::-1] > 0, axis=1)
+		b = np.minimum(b, last[g])
+		# uniform within the part of the bin inside the galaxy's limits
+		lo = np.maximum(V_base[b], lolim_vol[gal[c]])
+		hi = np.minimum(V_base[b + 1], hilim_vol[gal[c]])
+		Vdraw[c] = lo + np.random.rand(len(b)) * (hi - lo)
+		good[c] = tot[g] > 0
+	return Vdraw[good], gal[good]
+
 def clone_galaxies(idcol, maxcol, Nrand=10, zlims=None, window_vol=None, area=180., dspec=None, save_diag=False,
 				   dobs=None, drawn_dobs=None, dres=1., Niter=15, load_windows=True, runid='', mincol=None):
 	# take arrays of IDs and max distances/redshifts
@@ -396,34 +439,19 @@ def clone_galaxies(idcol, maxcol, Nrand=10, zlims=None, window_vol=None, area=18
 		if this_iter > 1:
 			print '\t\t\t\ti.e. %+d'%(n_clones.sum() - prev_N)
 
-		ddraw, clone_ids = [], []
-		for i in tqdm(range(len(n_clones)), desc='\t\tcloning', ncols=100):
-			# skip bad galaxies
-			if n_clones[i] == 0:
-				continue
-
-			if not windowed or this_iter == 1:
-				# draw uniformly from the allowed volume
-				Vdraw = np.random.rand(n_clones[i]) * (hilim_vol[i] - lolim_vol[i]) + lolim_vol[i]
-			else:
-				# over-draw uniformly and reject excess clones according to window function
-				Vdraw1 = np.random.rand(n_clones[i]*100) * (hilim_vol[i] - lolim_vol[i]) + lolim_vol[i]
-				window_at_Vdraw = np.interp(Vdraw1, V_mid, windows[i])
-				if window_at_Vdraw.sum() == 0:
-					# skip bad windows
-					print 'galaxy', idcol[i], 'at z=%.3f'%get_z(dobs[i]), ' -- window is too small?'
-					continue
-				window_at_Vdraw /= window_at_Vdraw.sum()
-				Vdraw = np.random.choice(Vdraw1, p=window_at_Vdraw, size=n_clones[i])
-
-			ddraw_i = (3.*Vdraw/Om)**(1./3.)
-			assert all(ddraw_i <= hilim[i]) and all(ddraw_i >= lolim[i]), "z-limiting of clones is broken!"
-			for ddi in ddraw_i:
-				ddraw.append(ddi)
-				clone_ids.append(idcol[i])
-
-		ddraw = np.array(ddraw).flatten()
-		clone_ids = np.array(clone_ids).flatten()
+		if not windowed or this_iter == 1:
+			# draw uniformly from the allowed volume
+			Vdraw, gal = draw_clone_volumes(n_clones, lolim_vol, hilim_vol)
+		else:
+			# draw from window functions
+			Vdraw, gal = draw_clone_volumes(n_clones, lolim_vol, hilim_vol, windows=windows, V_base=V_base)
+			nbad = (n_clones > 0).sum() - len(np.unique(gal))
+			if nbad:
+				print '\t\t%s galaxies with windows too small to draw from -- skipped' % nbad
+
+		ddraw = (3.*Vdraw/Om)**(1./3.)
+		clone_ids = np.asarray(idcol)[gal]
+		assert np.all(ddraw <= hilim[gal]) and np.all(ddraw >= lolim[gal]), "z-limiting of clones is broken!"
 		assert len(ddraw) == len(clone_ids), "cloning going wrong!"
 
 		Delta_d_list.append(Delta_d)
@@ -0,0 +1,148 @@
+from __future__ import print_function, division
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+import treecorr
+import catalog_io
+from catalog_io import file_hash
+
+# TreeCorr config entries which change the parsed catalogue columns
+CONFIG_KEYS = ['file_type', 'delimiter', 'comment_marker', 'first_row', 'last_row',
+				'ra_col', 'dec_col', 'r_col', 'g1_col', 'g2_col', 'w_col',
+				'ra_units', 'dec_units', 'flip_g1', 'flip_g2']
+_caches = {}
+
+def array_hash(arr):
+	return hashlib.sha1(np.ascontiguousarray(arr).view(np.uint8)).hexdigest()
+
+def get_cache(cache_dir, max_gb=20.):
+	# one CatalogCache per directory & process, so in-memory catalogues persist between calls
+	cache_dir = os.path.abspath(cache_dir)
+	if cache_dir not in _caches:
+		_caches[cache_dir] = CatalogCache(cache_dir, max_bytes=float(max_gb) * 1e9)
+	return _caches[cache_dir]
+
+class CatalogCache:
+	"""
+	Content-addressed cache of parsed TreeCorr catalogues. Column arrays are
+	stored in cache_dir as <key>.npz, keyed by the file contents & column config,
+	and shared by every process pointed at the same directory. Files are evicted
+	least-recently-used once the directory exceeds max_bytes.
+
+	The last max_memory Catalog objects are also held in memory per (key, weights),
+	so that the fields/trees TreeCorr builds on them are reused between calls, as
+	are the parsed columns of the last max_memory catalogues. cache_dir=None gives
+	a memory-only cache (e.g. for one batch of correlations), holding just these.
+	"""
+	def __init__(self, cache_dir, max_bytes=20e9, max_memory=8):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		self.max_memory = max_memory
+		self.memory = OrderedDict()
+		self.parsed = OrderedDict() # parsed columns per key, least-recently-used first
+		self.lock = threading.RLock() # get() may be called from concurrent threads
+		if (cache_dir is not None) and (not os.path.isdir(cache_dir)):
+			try:
+				os.makedirs(cache_dir)
+			except OSError: # made by another process
+				pass
+
+	def key(self, path, config, is_rand=0):
+		conf = tuple((k, str(config[k])) for k in CONFIG_KEYS if k in config)
+		return hashlib.sha1(repr((file_hash(catalog_io.source(path)), conf, int(is_rand))).encode()).hexdigest()
+
+	def entry(self, key):
+		return os.path.join(self.cache_dir, key + '.npz')
+
+	def get(self, path, config, is_rand=0, w=None, memo=1):
+		# return Catalog for path, parsing the file only on a cache miss
+		# w: optional weights replacing those read from file (e.g. random thinning)
+		# memo: 0 = don't hold the Catalog in memory (e.g. weights that never recur)
+		key = self.key(path, config, is_rand)
+		mkey = (key, None if w is None else array_hash(w))
+		with self.lock:
+			if mkey in self.memory:
+				cat = self.memory.pop(mkey)
+				self.memory[mkey] = cat
+				return cat
+
+			cols = self.load(key)
+			if cols is None:
+				cols = self.columns(catalog_io.treecorr_catalog(path, config, is_rand=is_rand))
+				self.save(key, cols)
+			cat = self.build(cols, w=w)
+
+			if memo:
+				self.memory[mkey] = cat
+				while len(self.memory) > self.max_memory:
+					self.memory.popitem(last=False)
+			return cat
+
+	def columns(self, cat):
+		cols = {'ra': cat.ra, 'dec': cat.dec, 'r': cat.r,
+				'w': np.ones(cat.ntot) if cat.w is None else cat.w}
+		if cat.g1 is not None:
+			cols['g1'], cols['g2'] = cat.g1, cat.g2
+		return cols
+
+	def build(self, cols, w=None):
+		# shears are stored post-flip, so no flip_g1/2 here
+		kw = dict((k, cols[k]) for k in ['ra', 'dec', 'r', 'g1', 'g2'] if k in cols)
+		kw['w'] = cols['w'] if w is None else w
+		return treecorr.Catalog(ra_units='radians', dec_units='radians', **kw)
+
+	def remember(self, key, cols):
+		self.parsed.pop(key, None)
+		self.parsed[key] = cols
+		while len(self.parsed) > self.max_memory:
+			self.parsed.popitem(last=False)
+		return cols
+
+	def load(self, key):
+		if key in self.parsed:
+			return self.remember(key, self.parsed[key])
+		if self.cache_dir is None:
+			return None
+		fname = self.entry(key)
+		try:
+			with np.load(fname) as f:
+				cols = dict((k, f[k]) for k in f.files)
+			os.utime(fname, None) # mark as recently used
+			return self.remember(key, cols)
+		except (IOError, OSError, ValueError):
+			return None
+
+	def save(self, key, cols):
+		# write-then-rename, so concurrent processes never read partial entries
+		self.remember(key, cols)
+		if self.cache_dir is None:
+			return
+		fd, tmp = tempfile.mkstemp(prefix='tmp', suffix='.npz', dir=self.cache_dir)
+		os.close(fd)
+		np.savez(tmp, **cols)
+		os.rename(tmp, self.entry(key))
+		self.evict()
+
+	def evict(self):
+		entries = []
+		for f in os.listdir(self.cache_dir):
+			if f.endswith('.npz') and not f.startswith('tmp'):
+				try:
+					st = os.stat(os.path.join(self.cache_dir, f))
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, f))
+		entries.sort()
+		total = sum(e[1] for e in entries)
+		for mtime, size, f in entries[:-1]:
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(os.path.join(self.cache_dir, f))
+			except OSError:
+				pass
+			total -= size
+
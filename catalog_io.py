@@ -0,0 +1,168 @@
+from __future__ import print_function, division
+import os
+import tempfile
+import shutil
+import hashlib
+import numpy as np
+from os.path import join, dirname, basename, exists, getmtime
+from astropy.io import ascii
+
+_file_hashes = {}
+
+def file_hash(path, blocksize=2**24):
+	# sha1 of file contents, memoised on (path, size, mtime)
+	st = os.stat(path)
+	stamp = (os.path.abspath(path), st.st_size, st.st_mtime)
+	if stamp not in _file_hashes:
+		sha = hashlib.sha1()
+		with open(path, 'rb') as f:
+			for block in iter(lambda: f.read(blocksize), b''):
+				sha.update(block)
+		_file_hashes[stamp] = sha.hexdigest()
+	return _file_hashes[stamp]
+
+# binary copies of catalogue files live in npy/<name>.npy beside the ascii path, as
+# column-major (Fortran) float64 arrays -- so memory-mapped columns are contiguous
+BINARY_DIR = 'npy'
+
+def binary_path(path):
+	return join(dirname(path), BINARY_DIR, basename(path) + '.npy')
+
+def names_path(path):
+	return binary_path(path)[:-4] + '.names'
+
+def stamp_path(path):
+	# (mtime, size) of the ascii last exported from the binary copy
+	return binary_path(path)[:-4] + '.exported'
+
+def _ascii_stamp(path):
+	st = os.stat(path)
+	return '%r %i'%(st.st_mtime, st.st_size)
+
+def exported(path):
+	# ascii at path was written by export_ascii, from the current binary copy
+	try:
+		with open(stamp_path(path)) as f:
+			return f.read() == _ascii_stamp(path)
+	except (IOError, OSError):
+		return False
+
+def has_binary(path):
+	# binary copy exists, and any ascii file at path is older or was exported from it
+	b = binary_path(path)
+	return exists(b) and ((not exists(path)) or (getmtime(b) >= getmtime(path)) or exported(path))
+
+def source(path):
+	# the file read for path: binary copy if fresh, else ascii
+	return (path, binary_path(path))[has_binary(path)]
+
+def listdir(d):
+	# directory listing, with binary-only catalogues listed under their ascii names
+	files = [f for f in os.listdir(d) if (f != BINARY_DIR) and not f.startswith('.tmp')]
+	bdir = join(d, BINARY_DIR)
+	if os.path.isdir(bdir):
+		have = set(files)
+		files += [f[:-4] for f in os.listdir(bdir) if f.endswith('.npy') and (not f.startswith('.tmp')) and (f[:-4] not in have)]
+	return files
+
+def _write(fname, writer, suffix):
+	# write-then-rename, so concurrent readers never see partial files
+	fd, tmp = tempfile.mkstemp(prefix='.tmp', suffix=suffix, dir=dirname(fname) or '.')
+	os.close(fd)
+	writer(tmp)
+	os.rename(tmp, fname)
+
+def _text(text):
+	def writer(fname):
+		with open(fname, 'w') as f:
+			f.write(text)
+	return writer
+
+def _remove(files):
+	for f in files:
+		if exists(f):
+			os.remove(f)
+
+def write(path, arr, names, binary=0, delimiter='\t'):
+	"""
+	save catalogue arr to path -- as ascii, or only as a binary copy if binary (see export_ascii)
+	names: ascii column names (kept in the .npy directory if binary)
+	"""
+	if not binary:
+		_write(path, lambda tmp: ascii.write(arr, tmp, names=names, delimiter=delimiter, overwrite=1), suffix='.asc')
+		_remove([binary_path(path), names_path(path), stamp_path(path)]) # stale binary
+		return path
+	arr = np.asfortranarray(arr, dtype=float)
+	bdir = join(dirname(path), BINARY_DIR)
+	if not os.path.isdir(bdir):
+		try:
+			os.makedirs(bdir)
+		except OSError: # made by another process
+			pass
+	_write(names_path(path), _text('\t'.join(names)), suffix='.names')
+	_write(binary_path(path), lambda tmp: np.save(tmp, arr), suffix='.npy')
+	_remove([path, stamp_path(path)]) # stale ascii
+	return path
+
+def read(path, mmap=1, **kwargs):
+	# catalogue array from binary copy (memory-mapped if mmap) if fresh, else np.loadtxt(path, **kwargs)
+	if has_binary(path):
+		return np.load(binary_path(path), mmap_mode=('r' if mmap else None))
+	return np.loadtxt(path, **kwargs)
+
+def count(path):
+	# number of rows, from the .npy header if there is a fresh binary copy, else counted
+	# (not parsed) from the ascii lines
+	if has_binary(path):
+		return np.load(binary_path(path), mmap_mode='r').shape[0]
+	with open(path) as f:
+		return sum(1 for l in f if l.strip() and not l.lstrip().startswith('#'))
+
+def names(path):
+	# ascii column names of catalogue at path
+	if has_binary(path):
+		with open(names_path(path)) as f:
+			return f.read().split('\t')
+	return list(ascii.read(path).keys())
+
+def export_ascii(path, delimiter='\t'):
+	# thin ascii export for the wcorr binary -- no-op if there is no binary copy, or the ascii
+	# was already exported from it; stamped so the binary stays fresh (see has_binary)
+	if (not has_binary(path)) or (exists(path) and exported(path)):
+		return path
+	arr = np.load(binary_path(path), mmap_mode='r')
+	_write(path, lambda tmp: ascii.write(arr, tmp, names=names(path), delimiter=delimiter, overwrite=1), suffix='.asc')
+	_write(stamp_path(path), _text(_ascii_stamp(path)), suffix='.exported')
+	return path
+
+def copy(path, new_path):
+	# copy catalogue at path (ascii or binary copy & export) to new_path, keeping mtimes -- so
+	# the binary stays as fresh, and an exported ascii matches its stamp
+	for f in [lambda p: p, binary_path, names_path, stamp_path]:
+		src, dst = f(path), f(new_path)
+		if exists(src):
+			if not os.path.isdir(dirname(dst)):
+				os.makedirs(dirname(dst))
+			shutil.copy2(src, dst)
+	return new_path
+
+def remove(path):
+	_remove([path, binary_path(path), names_path(path), stamp_path(path)])
+
+def treecorr_catalog(path, config, is_rand=0):
+	# treecorr.Catalog from the binary copy of path if fresh, else parsed by TreeCorr
+	import treecorr
+	if not has_binary(path):
+		return treecorr.Catalog(path, config, is_rand=is_rand)
+	arr = np.load(binary_path(path), mmap_mode='r')
+	col = lambda k: np.array(arr[:, int(config[k]) - 1]) if int(config.get(k, 0)) > 0 else None
+	kw = dict(ra=col('ra_col'), dec=col('dec_col'), r=col('r_col'), w=col('w_col'),
+				ra_units=config['ra_units'], dec_units=config['dec_units'])
+	if not is_rand:
+		g1, g2 = col('g1_col'), col('g2_col')
+		if g1 is not None:
+			flip = lambda k: str(config.get(k, False)).lower() in ['true', '1', 'yes']
+			kw['g1'], kw['g2'] = (g1, -g1)[flip('flip_g1')], (g2, -g2)[flip('flip_g2')]
+	kw = dict((k, v) for k, v in kw.items() if v is not None)
+	return treecorr.Catalog(**kw)
+
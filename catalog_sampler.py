@@ -10,8 +10,7 @@ import os
 import argparse
 import csv
 from astropy import cosmology
-from astropy.cosmology import FlatLambdaCDM as FLCDM
-MICEcosmo = FLCDM(Om0=0.25, H0=70, Ob0=0.044)
+from distances import get_distances
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
@@ -27,10 +26,12 @@ import gc
 import astropy.stats as astat
 import jackknife3d as jk3d
 import downsampler as ds
+import catalog_io
 ds_jkfunc = ds.make_jks
 import pickle
 
 class RealCatalogue:
+	binary_io = 0 # 1 = patch/JK intermediates saved in binary only (catalog_io), ascii exported on demand
 
 	def __init__(self, path, DEI, mc, SDSS, other=0, radians=0, cols=None, largePi=0, MICEdensity=0, SHIFT=0, PLOTNOW=0): # ADD MORE self.SPECS HERE; FEWER ARGS FOR FNS!
 		"""""
@@ -422,7 +423,7 @@ class RealCatalogue:
 		if 'chi_comov_TONRY' in table.columns.names:
 			comov = table['chi_comov_TONRY']
 		else:
-			comov = MICEcosmo.comoving_distance(Z)
+			comov = get_distances().chi(Z, h_units=0)
 		comov *= h
 		new_table = np.column_stack((RA,DEC,comov,e1,e2,e_weight))[shape_cut]
 
@@ -451,7 +452,7 @@ class RealCatalogue:
 		if not isdir(outfile_root):
 			mkdir(outfile_root)
 
-		ascii.write(new_table, join(outfile_root, label + ".asc"), names=['# ra[rad]', 'dec[rad]', 'chi[Mpc/h]', 'e1', 'e2', 'e_weight'], delimiter='\t', overwrite=1)
+		catalog_io.write(join(outfile_root, label + ".asc"), new_table, names=['# ra[rad]', 'dec[rad]', 'chi[Mpc/h]', 'e1', 'e2', 'e_weight'])
 		sample_no = "%s # objects:\t%s"%(label,len(new_table))
 		return sample_no
 
@@ -474,7 +475,7 @@ class RealCatalogue:
 			e2 = np.ones_like(Z)
 		newtable = np.column_stack((RA,DEC,Z,e1,e2))
 
-		ascii.write(newtable, join(self.new_root, 'swot_%s.asc'%label), names=['# ra[deg]', 'dec[deg]', 'z', 'e1', 'e2'], delimiter='\t', overwrite=1)
+		catalog_io.write(join(self.new_root, 'swot_%s.asc'%label), newtable, names=['# ra[deg]', 'dec[deg]', 'z', 'e1', 'e2'])
 
 		return Z # for random downsampling
 
@@ -488,7 +489,7 @@ class RealCatalogue:
 		if not isdir(sw_pDir):
 			mkdir(sw_pDir)
 
-		ascii.write(newpatch,join(sw_pDir,label+'%spatch.asc'%str(pnum).zfill(3)),names=['# ra[deg]','dec[deg]','z'],delimiter='\t', overwrite=1)
+		catalog_io.write(join(sw_pDir,label+'%spatch.asc'%str(pnum).zfill(3)), newpatch, names=['# ra[deg]','dec[deg]','z'])
 
 	def make_combos(self, densColours):
 		# construct sets of filenames, counts, & IDs for wcorr-calls
@@ -717,25 +718,42 @@ class RealCatalogue:
 		if not isdir(patchDir):
 			mkdir(patchDir)
 		patchName = join(patchDir,label+'%spatch.asc'%str(p_num).zfill(3))
-		ascii.write(patch, patchName, delimiter='\t', names=['# ra[rad]', 'dec[rad]', 'chi[Mpc/h]', 'e1', 'e2', 'e_weight'], overwrite=1)
+		catalog_io.write(patchName, patch, names=['# ra[rad]', 'dec[rad]', 'chi[Mpc/h]', 'e1', 'e2', 'e_weight'], binary=self.binary_io)
 		return patchDir
 
+	def copy_patches(self, outfile_root, label):
+		# largePi patches of sample label, copied from the standard pass -- same regions & columns
+		patchDir, lpDir = join(outfile_root, label), join(outfile_root, label + '_largePi')
+		if not isdir(lpDir):
+			mkdir(lpDir)
+		for patch in catalog_io.listdir(patchDir):
+			if patch.startswith(label) and patch.endswith('patch.asc'):
+				catalog_io.copy(join(patchDir, patch), join(lpDir, label + '_largePi' + patch[len(label):]))
+		if os.path.exists(join(patchDir, 'cubes.txt')):
+			catalog_io.copy(join(patchDir, 'cubes.txt'), join(lpDir, 'cubes.txt'))
+		return lpDir
+
 	def wcorr_patches(self, patchDir, rp_bins, rp_lims, los_bins, los_lim, nproc, largePi):
-		patches = [patch for patch in listdir(patchDir) if ('wcorr' not in patch)&('_' in patch)]
+		patches = [patch for patch in catalog_io.listdir(patchDir) if ('wcorr' not in patch)&('_' in patch)]
 		patches.sort()
 		label = basename(normpath(patchDir))
 		if 'highZ' in label:
 			dDir = join(patchDir,'..','highZ')
 		if 'lowZ' in label:
 			dDir = join(patchDir,'..','lowZ')
-		dpatches = listdir(dDir)
+		dpatches = catalog_io.listdir(dDir)
 		dpatches.sort()
+		# wcorr reads ascii
+		for p in dpatches:
+			catalog_io.export_ascii(join(dDir, p))
+		for p in patches:
+			catalog_io.export_ascii(join(patchDir, p))
 		os.system('cp %s/* %s'%(dDir,patchDir))
 		print('correlating patch (BCG=%s) densities with %s (BCG=%s) shapes...'%(self.BCGargs[0],label,self.BCGargs[1]))
 		# print('is BCGs: shape=%s, dens=%s'%(self.BCGargs[0],self.BCGargs[1]))
 		for i,p in enumerate(patches):
-			pCount = len(np.loadtxt(join(patchDir,p)))
-			dCount = len(np.loadtxt(join(patchDir,dpatches[i])))
+			pCount = catalog_io.count(join(patchDir,p))
+			dCount = catalog_io.count(join(dDir,dpatches[i]))
 			# print("patch %s, density popn %s, shapes popn %s"%((i+1),dCount,pCount))
 			os.system('/share/splinter/hj/PhD/CosmoFisherForecast/obstools/wcorr %s %s %s %s %s %s %s %s %s %s %s %s 0 0'%(patchDir,dpatches[i],dCount,p,pCount,rp_bins,rp_lims[0],rp_lims[1],los_bins,los_lim,p[:-9],nproc))
 			if largePi:
@@ -806,10 +824,14 @@ class RealCatalogue:
 
 		return None
 
-	def jackknife_patches(self, patchDir):
+	def jackknife_patches(self, patchDir, jk_masks=0):
 		# resample patches & save JK samples
-		patches = [x for x in listdir(patchDir) if ('patch' in x)&('_' in x)]
-		patch_cats = np.array([np.loadtxt(join(patchDir,i)) for i in patches])
+		# jk_masks: save one region-labelled catalogue instead, for JK samples as index masks
+		if jk_masks:
+			self.label_patches(patchDir)
+			return None
+		patches = [x for x in catalog_io.listdir(patchDir) if ('patch' in x)&('_' in x)]
+		patch_cats = np.array([catalog_io.read(join(patchDir,i)) for i in patches])
 
 		JKdir = join(patchDir,'JKsamples')
 		if not isdir(JKdir):
@@ -818,26 +840,72 @@ class RealCatalogue:
 			del_one = np.delete(patch_cats,i,axis=0)
 			new_cat = np.concatenate(del_one)
 			cat_name = join(JKdir,'JKsample%s.asc'%(str(i).zfill(3)))
-			ascii.write(new_cat, cat_name, delimiter='\t', names=['# ra[rad]', 'dec[rad]', 'chi[Mpc/h]', 'e1', 'e2', 'e_weight'], overwrite=1)
+			catalog_io.write(cat_name, new_cat, names=['# ra[rad]', 'dec[rad]', 'chi[Mpc/h]', 'e1', 'e2', 'e_weight'], binary=self.binary_io)
 
 		return None
 
+	def save_cube_index(self, outfile_root, label, cube_cut, largePi):
+		# global cube number of each patch file (in patch-number order), so that samples whose patches
+		# come from different cube cuts can be labelled by the same regions (see label_patches)
+		patchDir = join(outfile_root, label + ('', '_largePi')[largePi])
+		if isdir(patchDir):
+			np.savetxt(join(patchDir, 'cubes.txt'), np.where(cube_cut)[0], fmt='%i')
+
+	def cube_index(self, patchDir, npatch):
+		# global cube number of each patch file -- patch numbers if no cubes.txt was saved
+		f = join(patchDir, 'cubes.txt')
+		if os.path.exists(f):
+			return np.atleast_1d(np.loadtxt(f, dtype=int))
+		return np.arange(npatch)
+
+	def label_patches(self, patchDir):
+		# concatenate patches into JKsamples/JKlabelled.asc, labelled by global cube number; only
+		# rewritten if older than the patches. Returns path, labels & cube number of each patch file
+		JKdir = join(patchDir,'JKsamples')
+		if not isdir(JKdir):
+			mkdir(JKdir)
+		patches = [x for x in catalog_io.listdir(patchDir) if x.endswith('patch.asc')]
+		patches.sort()
+		cubes = self.cube_index(patchDir, len(patches))
+		catf, labf = join(JKdir, 'JKlabelled.asc'), join(JKdir, 'JKlabelled_jk.txt')
+		inputs = [catalog_io.source(join(patchDir, x)) for x in patches + ['cubes.txt']]
+		newest = max(os.path.getmtime(f) for f in inputs if os.path.exists(f))
+		if os.path.exists(labf) and os.path.exists(catalog_io.source(catf)) and \
+				min(os.path.getmtime(labf), os.path.getmtime(catalog_io.source(catf))) >= newest:
+			return catf, np.atleast_1d(np.loadtxt(labf, dtype=int)), cubes
+		pcats = [catalog_io.read(join(patchDir, x), ndmin=2) for x in patches]
+		labels = np.concatenate([np.ones(len(pc), dtype=int) * cubes[j] for j, pc in enumerate(pcats)])
+		catalog_io.write(catf, np.concatenate(pcats), names=['# ra[rad]', 'dec[rad]', 'chi[Mpc/h]', 'e1', 'e2', 'e_weight'], binary=self.binary_io)
+		np.savetxt(labf, labels, fmt='%i')
+		return catf, labels, cubes
+
 	def run_treecorr(self, densf, shapesf, drandf, srandf, config, outfile, **kwargs):
 		# config & kwargs constructed from command line args for the main script
 		import treecorr_3DCF
 		tcw = treecorr_3DCF.compute_w
 		config1 = config.copy()
 
-		r, wgp, wgx, err, npair = tcw([densf, shapesf], [drandf, srandf], config1, **kwargs)
+		r, wgp, wgx, err, npair = tcw([densf, shapesf], [drandf, srandf], config1, **kwargs)[:5] # + 3D grids if return_3d
 		# mimic BJ code output
 		one_col = np.ones_like(r, dtype=float)
 		out_arr = np.column_stack((r, one_col, one_col, wgp, wgx, one_col, err, npair))
 		np.savetxt(outfile, out_arr)
 
-	def wcorr_jackknife(self, patchDir, rp_bins, rp_lims, los_bins, los_lim, nproc, largePi, densColours, treecorr=None, **kwargs):
+	def run_treecorr_batch(self, combos, config, outfiles, nproc, **kwargs):
+		# run_treecorr for several (densf, shapesf, drandf, srandf) combos at once, sharing catalogues/trees
+		import treecorr_3DCF
+		jobs = [([densf, shapesf], [drandf, srandf]) for densf, shapesf, drandf, srandf in combos]
+		outs = treecorr_3DCF.compute_w_batch(jobs, config.copy(), nproc=nproc, **kwargs)
+		for out, outfile in zip(outs, outfiles):
+			r, wgp, wgx, err, npair = out[:5] # + 3D grids if return_3d
+			one_col = np.ones_like(r, dtype=float)
+			out_arr = np.column_stack((r, one_col, one_col, wgp, wgx, one_col, err, npair))
+			np.savetxt(outfile, out_arr)
+
+	def wcorr_jackknife(self, patchDir, rp_bins, rp_lims, los_bins, los_lim, nproc, largePi, densColours, treecorr=None, analytic=0, jk_masks=0, jk_workers=1, **kwargs):
 		# wcorr JK samples - this function gets called only for shapes samples
 		JKdir = join(patchDir,'JKsamples')
-		JKsamples = [x for x in listdir(JKdir) if x.startswith('JKsample') & x.endswith('.asc')]
+		JKsamples = [x for x in catalog_io.listdir(JKdir) if x.startswith('JKsample') & x.endswith('.asc')]
 		JKsamples.sort()
 		pdir_key = basename(normpath(patchDir))
 		#print('CHECK THESE:\n\n\n\n')
@@ -856,50 +924,101 @@ class RealCatalogue:
 		#print('dens_dir:\t', dens_dir)
 		#print('\n\n\n\n')
 
+		if treecorr and (analytic or jk_masks):
+			print("correlating (BCG=%s) density sample with labelled %s (BCG=%s) shapes, jackknife regions as %s (largePi=%s)..."%(self.BCGargs[0],pdir_key,self.BCGargs[1],('index masks', 'per-region pair counts')[analytic],largePi))
+			self.treecorr_jackknife(patchDir, dens_dir, largePi, kwargs['tc_config'], kwargs['tc3dcf_kwargs'], analytic=analytic, nproc=nproc, jk_workers=jk_workers)
+			return None
+
 		print("correlating (BCG=%s) density sample with jackknife_i %s (BCG=%s) shapes (largePi=%s)..."%(self.BCGargs[0],pdir_key,self.BCGargs[1],largePi))
-		for i,jk in enumerate(JKsamples):
-			dpath = join(dens_dir, 'JKsamples', jk)
-			randjk = 'rand_'+jk
-			rdpath = join(dens_dir, 'JKsamples', randjk)
-			os.system('cp %s %s_d'%(dpath, join(JKdir, jk)))
-			os.system('cp %s %s'%(rdpath, join(JKdir, randjk)))
-			dCount = np.loadtxt(dpath).shape[0]
-			rdCount = np.loadtxt(rdpath).shape[0]
-			jkCount = np.loadtxt(join(JKdir, jk)).shape[0]
-
-			if not treecorr:
-				if largePi:
-					os.system('/share/splinter/hj/PhD/CosmoFisherForecast/obstools/wcorr %s %s_d %s %s %s %s %s %s %s %s %s_largePi %s 1 0'%(JKdir,jk,dCount,jk,jkCount,rp_bins,rp_lims[0],rp_lims[1],los_bins,los_lim,jk[:-4],nproc))
-					os.system('/share/splinter/hj/PhD/CosmoFisherForecast/obstools/wcorr %s %s %s %s %s %s %s %s %s %s %s_largePi %s 1 0'%(JKdir,randjk,rdCount,jk,jkCount,rp_bins,rp_lims[0],rp_lims[1],los_bins,los_lim,'rand_'+jk[:-4],nproc))
-					real_out, rand_out = join(JKdir, 'wcorr_'+jk[:-4]+'_largePi.dat'), join(JKdir, 'wcorr_rand_'+jk[:-4]+'_largePi.dat')
+		jobs = [dict(JKdir=JKdir, jk=jk, dens_dir=dens_dir, rp_bins=rp_bins, rp_lims=rp_lims,
+					los_bins=los_bins, los_lim=los_lim, largePi=largePi, treecorr=treecorr,
+					rm_dens=(densColours | ('_Blue' in patchDir)),
+					tc_config=kwargs.get('tc_config'), tc3dcf_kwargs=kwargs.get('tc3dcf_kwargs'))
+				for jk in JKsamples]
+
+		# resume: skip regions already correlated by an earlier run
+		todo = []
+		for job in jobs:
+			if jk_region_done(job):
+				print('%s already correlated -- skipping'%job['jk'])
+				jk_region_cleanup(job)
+			else:
+				todo.append(job)
+		jobs = todo
+		if len(jobs) == 0:
+			return None
+
+		# distribute regions over workers, splitting nproc between them
+		workers = max(1, min(int(jk_workers), len(jobs)))
+		for job in jobs:
+			job['nproc'] = max(1, nproc // workers)
+		if workers == 1:
+			results = (wcorr_jk_region(job) for job in jobs)
+		else:
+			import multiprocessing
+			pool = multiprocessing.Pool(workers)
+			results = pool.imap_unordered(wcorr_jk_region, jobs)
+		for i, jk in enumerate(results):
+			print('%i / %i jackknife regions done (%s)'%(i+1, len(jobs), jk))
+		if workers > 1:
+			pool.close()
+			pool.join()
 
-				else:
-					os.system('/share/splinter/hj/PhD/CosmoFisherForecast/obstools/wcorr %s %s_d %s %s %s %s %s %s %s %s %s %s 0 0'%(JKdir,jk,dCount,jk,jkCount,rp_bins,rp_lims[0],rp_lims[1],los_bins,los_lim,jk[:-4],nproc))
-					os.system('/share/splinter/hj/PhD/CosmoFisherForecast/obstools/wcorr %s %s %s %s %s %s %s %s %s %s %s %s 0 0'%(JKdir,randjk,rdCount,jk,jkCount,rp_bins,rp_lims[0],rp_lims[1],los_bins,los_lim,'rand_'+jk[:-4],nproc))
-					real_out, rand_out = join(JKdir, 'wcorr_'+jk[:-4]+'.dat'), join(JKdir, 'wcorr_rand_'+jk[:-4]+'.dat')
-
-				realcorr, randcorr = np.loadtxt(real_out), np.loadtxt(rand_out)
-				realcorr[:, 3:5] -= randcorr[:, 3:5]
-				np.savetxt(real_out, realcorr)
-
-			elif treecorr:
-				# densf, shapesf, drandf, srandf, config, outfile,
-				# estim='PW1', np=16, **kwargs(nbins_rpar=30, random_oversampling=10., verbosity=1, load_RRs, save_RRs)
-				outf = (join(JKdir,'wcorr_'+jk[:-4]+'.dat'),
-						join(JKdir,'wcorr_'+jk[:-4]+'_largePi.dat')) [largePi]
-				print('%i / %i' % (i+1, len(JKsamples)))
-				self.run_treecorr(dpath, join(JKdir,jk), rdpath, rdpath, kwargs['tc_config'], outf, **kwargs['tc3dcf_kwargs'])
-
-			# clean up - if needing to analyse JKs, use arg 'makejk_only'- bypasses this function
-			if not treecorr:
-				os.system('rm %s'%rand_out) # random wcorr
-			os.system('rm %s_d'%join(JKdir, jk)) # copied density JK sample
-			os.system('rm %s'%join(JKdir, randjk)) # copied random JK sample
-			os.system('rm %s'%join(JKdir, jk)) # shapes JK sample
-			if densColours | ('_Blue' in patchDir):
-				os.system('rm %s'%dpath) # density JK sample
-				os.system('rm %s'%rdpath) # random sample
+		return None
 
+	def treecorr_jackknife(self, patchDir, dens_dir, largePi, tc_config, tc3dcf_kwargs, analytic=1, nproc=1, jk_workers=1):
+		# JK signals from region-labelled catalogues, in place of correlating every JKsample file --
+		# writes the same wcorr_JKsample*.dat files for jackknife()
+		# analytic=1: all delete-one signals from one measurement, by per-region pair counts
+		# analytic=0: correlate each delete-one sample, as index masks over the labelled catalogues,
+		#	with regions distributed over jk_workers processes
+		import treecorr_3DCF
+		JKdir = join(patchDir,'JKsamples')
+		densf, gd, dcubes = self.label_patches(dens_dir)
+		shapesf, gs, scubes = self.label_patches(patchDir)
+		randf = join(dens_dir, 'JKsamples', 'rand_labelled.asc')
+		lr = np.loadtxt(join(dens_dir, 'JKsamples', 'rand_labelled_jk.txt'), dtype=int) # numbered as the density patch files
+		gr = np.where(lr >= 0, dcubes[lr], -1)
+		# regions are the shapes cubes, in the order of jackknife()'s weights; density/randoms in
+		# other cubes are never deleted
+		region = -np.ones(max(dcubes.max(), scubes.max()) + 2, dtype=int)
+		region[scubes] = np.arange(len(scubes))
+		ld, ls, lr = region[gd], region[gs], region[gr] # label -1 indexes the final -1
+		njk = len(scubes)
+		outfs = [join(JKdir, 'wcorr_JKsample%s%s.dat'%(str(k).zfill(3), ('', '_largePi')[largePi])) for k in range(njk)]
+
+		if analytic:
+			tc_kwargs = dict(tc3dcf_kwargs)
+			tc_kwargs['single_pass'] = 1
+			out = treecorr_3DCF.compute_w([densf, shapesf], [randf, randf], tc_config.copy(), jk_labels=[ld, ls, lr, lr], **tc_kwargs)
+			r, npair, jk = out[0], out[4], out[-1]
+			one_col = np.ones_like(r, dtype=float)
+			for k in range(njk):
+				np.savetxt(outfs[k], np.column_stack((r, one_col, one_col, jk['gt'][k], jk['gx'][k], one_col, one_col, npair)))
+		else:
+			# labelled catalogues read once per worker, then masked per region
+			workers = max(1, min(int(jk_workers), njk))
+			config = tc_config.copy()
+			config['num_threads'] = max(1, nproc // workers)
+			# resume: skip regions whose output is newer than the labelled catalogues
+			inputs = [catalog_io.source(f) for f in [densf, shapesf, randf]]
+			jobs = [dict(k=k, outf=outfs[k], densf=densf, shapesf=shapesf, randf=randf,
+						tc_config=config, tc3dcf_kwargs=tc3dcf_kwargs) for k in range(njk)
+					if not newer_than(outfs[k], inputs)]
+			if len(jobs) < njk:
+				print('%i / %i jackknife regions already correlated -- skipping'%(njk - len(jobs), njk))
+			if workers == 1:
+				_init_jk_worker((ld, ls, lr))
+				results = (treecorr_jk_mask_region(job) for job in jobs)
+			else:
+				import multiprocessing
+				pool = multiprocessing.Pool(workers, initializer=_init_jk_worker, initargs=((ld, ls, lr),))
+				results = pool.imap_unordered(treecorr_jk_mask_region, jobs)
+			for i, k in enumerate(results):
+				print('%i / %i jackknife regions done'%(i+1, len(jobs)))
+			if workers > 1:
+				pool.close()
+				pool.join()
 		return None
 
 	def pearson_r(self,covar_matrix):
@@ -1018,11 +1137,151 @@ class RandomCatalogue(RealCatalogue):
 		DEC = np.deg2rad(table.T[1])
 		Z = table.T[2]
 		e1 = e2 = e_weight = np.ones_like(Z)
-		comov = MICEcosmo.comoving_distance(Z)
+		comov = get_distances().chi(Z, h_units=0)
 		comov *= h
 		new_table = np.column_stack((RA,DEC,comov,e1,e2,e_weight))
 		return new_table
 
+_jk_shared = None
+
+def _init_jk_worker(labels):
+	# per-process store of the region-labelled catalogues & their labels, shared by every region
+	# this worker correlates (see RealCatalogue.treecorr_jackknife)
+	global _jk_shared
+	import catalog_cache
+	_jk_shared = dict(catalogs=catalog_cache.CatalogCache(None), labels=labels)
+
+def treecorr_jk_mask_region(job):
+	# correlate delete-one region k as index masks over the shared labelled catalogues; returns k
+	import treecorr_3DCF
+	k = job['k']
+	ld, ls, lr = _jk_shared['labels']
+	masks = [ld != k, ls != k, lr != k, lr != k]
+	r, wgp, wgx, err, npair = treecorr_3DCF.compute_w([job['densf'], job['shapesf']], [job['randf'], job['randf']], job['tc_config'].copy(),
+														catalogs=_jk_shared['catalogs'], masks=masks, **job['tc3dcf_kwargs'])[:5]
+	one_col = np.ones_like(r, dtype=float)
+	np.savetxt(job['outf'], np.column_stack((r, one_col, one_col, wgp, wgx, one_col, err, npair)))
+	return k
+
+def newer_than(outf, inputs):
+	# outf exists and was written after every existing input
+	if not os.path.exists(outf):
+		return False
+	mtimes = [os.path.getmtime(f) for f in inputs if os.path.exists(f)]
+	return os.path.getmtime(outf) >= max(mtimes + [0])
+
+def jk_region_outfile(job):
+	return join(job['JKdir'], 'wcorr_'+job['jk'][:-4]+('.dat', '_largePi.dat')[job['largePi']])
+
+def jk_region_done(job):
+	# region correlated by an earlier run: its output is newer than the JK samples it came from
+	# (those are deleted once done), and no wcorr random-subtraction was left pending
+	JKdir, jk = job['JKdir'], job['jk']
+	inputs = [catalog_io.source(f) for f in [join(JKdir, jk), join(job['dens_dir'], 'JKsamples', jk),
+											join(job['dens_dir'], 'JKsamples', 'rand_'+jk)]]
+	rand_out = join(JKdir, 'wcorr_rand_'+jk[:-4]+('.dat', '_largePi.dat')[job['largePi']])
+	return newer_than(jk_region_outfile(job), inputs) and (job['treecorr'] or not os.path.exists(rand_out))
+
+def jk_region_cleanup(job):
+	# clean up - if needing to analyse JKs, use arg 'makejk_only'- bypasses this function
+	JKdir, jk = job['JKdir'], job['jk']
+	for f in [join(JKdir, jk)+'_d', join(JKdir, 'rand_'+jk)]: # density & random copies for wcorr
+		if os.path.exists(f):
+			os.remove(f)
+	catalog_io.remove(join(JKdir, jk)) # shapes JK sample
+	if job['rm_dens']:
+		catalog_io.remove(join(job['dens_dir'], 'JKsamples', jk)) # density JK sample
+		catalog_io.remove(join(job['dens_dir'], 'JKsamples', 'rand_'+jk)) # random sample
+
+def wcorr_jk_region(job):
+	# correlate one jackknife region (see RealCatalogue.wcorr_jackknife); returns the JKsample name
+	JKdir, jk, dens_dir, largePi = job['JKdir'], job['jk'], job['dens_dir'], job['largePi']
+	rp_bins, rp_lims, los_bins, los_lim, nproc = job['rp_bins'], job['rp_lims'], job['los_bins'], job['los_lim'], job['nproc']
+	dpath = join(dens_dir, 'JKsamples', jk)
+	randjk = 'rand_'+jk
+	rdpath = join(dens_dir, 'JKsamples', randjk)
+
+	if not job['treecorr']:
+		# wcorr reads ascii
+		for f in [dpath, rdpath, join(JKdir, jk)]:
+			catalog_io.export_ascii(f)
+		os.system('cp %s %s_d'%(dpath, join(JKdir, jk)))
+		os.system('cp %s %s'%(rdpath, join(JKdir, randjk)))
+		dCount = catalog_io.count(dpath)
+		rdCount = catalog_io.count(rdpath)
+		jkCount = catalog_io.count(join(JKdir, jk))
+		if largePi:
+			os.system('/share/splinter/hj/PhD/CosmoFisherForecast/obstools/wcorr %s %s_d %s %s %s %s %s %s %s %s %s_largePi %s 1 0'%(JKdir,jk,dCount,jk,jkCount,rp_bins,rp_lims[0],rp_lims[1],los_bins,los_lim,jk[:-4],nproc))
+			os.system('/share/splinter/hj/PhD/CosmoFisherForecast/obstools/wcorr %s %s %s %s %s %s %s %s %s %s %s_largePi %s 1 0'%(JKdir,randjk,rdCount,jk,jkCount,rp_bins,rp_lims[0],rp_lims[1],los_bins,los_lim,'rand_'+jk[:-4],nproc))
+			real_out, rand_out = join(JKdir, 'wcorr_'+jk[:-4]+'_largePi.dat'), join(JKdir, 'wcorr_rand_'+jk[:-4]+'_largePi.dat')
+
+		else:
+			os.system('/share/splinter/hj/PhD/CosmoFisherForecast/obstools/wcorr %s %s_d %s %s %s %s %s %s %s %s %s %s 0 0'%(JKdir,jk,dCount,jk,jkCount,rp_bins,rp_lims[0],rp_lims[1],los_bins,los_lim,jk[:-4],nproc))
+			os.system('/share/splinter/hj/PhD/CosmoFisherForecast/obstools/wcorr %s %s %s %s %s %s %s %s %s %s %s %s 0 0'%(JKdir,randjk,rdCount,jk,jkCount,rp_bins,rp_lims[0],rp_lims[1],los_bins,los_lim,'rand_'+jk[:-4],nproc))
+			real_out, rand_out = join(JKdir, 'wcorr_'+jk[:-4]+'.dat'), join(JKdir, 'wcorr_rand_'+jk[:-4]+'.dat')
+
+		realcorr, randcorr = np.loadtxt(real_out), np.loadtxt(rand_out)
+		realcorr[:, 3:5] -= randcorr[:, 3:5]
+		np.savetxt(real_out, realcorr)
+
+	else:
+		# densf, shapesf, drandf, srandf, config, outfile,
+		# estim='PW1', np=16, **kwargs(nbins_rpar=30, random_oversampling=10., verbosity=1, random_seed, rr_store)
+		import treecorr_3DCF
+		outf = (join(JKdir,'wcorr_'+jk[:-4]+'.dat'),
+				join(JKdir,'wcorr_'+jk[:-4]+'_largePi.dat')) [largePi]
+		config = job['tc_config'].copy()
+		config['num_threads'] = nproc
+		r, wgp, wgx, err, npair = treecorr_3DCF.compute_w([dpath, join(JKdir,jk)], [rdpath, rdpath], config, **job['tc3dcf_kwargs'])[:5]
+		one_col = np.ones_like(r, dtype=float)
+		np.savetxt(outf, np.column_stack((r, one_col, one_col, wgp, wgx, one_col, err, npair)))
+
+	if not job['treecorr']:
+		os.system('rm %s'%rand_out) # random wcorr
+	jk_region_cleanup(job)
+	return jk
+
+def _shift_G12(randoms):
+	# shift GAMA G12 randoms +1deg in dec, as the galaxies (SHIFT)
+	G12 = (randoms[:, 0] > 170) & (randoms[:, 0] < 190)
+	randoms[G12, 1] += 1
+	return randoms
+
+def jackknife_geometry(catalog, args, SHIFT, jk_regions):
+	# jackknife regions, weights & error scaling, with the downsampled randoms labelled by region --
+	# the sky geometry of the standard & largePi passes is identical, so main() builds it once
+	zlabel = catalog.cols[2]
+	sample_z = catalog.data[zlabel]
+	zlims = (sample_z.min(), sample_z.max())
+	shift = (None, _shift_G12)[int(bool((not args.SDSS) & SHIFT))]
+	nrand = ds.count_randoms(args.Random, zlims=zlims)
+
+	region_points = None
+	if args.jk_regions == 'area':
+		# k-means training points, from a thinned stream of the randoms
+		region_points = ds.stream_randoms(args.Random, zlims=zlims, accept=lambda z: min(1., 4e5 / nrand), transform=shift).T[:2]
+
+	# jkData.shape = (10 subsamples, N patches/cubes)
+	# random_labeller = function giving the cube number of (ra, dec, z) randoms, -1 = none
+	jkData, jkWeights, error_scaling, random_labeller = jk3d.resample_data(catalog.data, catalog.samplecuts, patchside=args.patchSize, zcut=args.zCut, do_sdss=(args.SDSS | args.other), do_3d=args.jk3d, cube_zdepth=args.cubeZdepth, largePi=0, bitmaskCut=args.bitmaskCut, occ_thresh=args.occ_thresh, SHIFT=SHIFT, cols=catalog.cols[:3], region_points=region_points, **jk_regions)
+	print('jkData: ', jkData.shape)
+	print('jkWeights: ', jkWeights.shape, '\n', jkWeights)
+	print('=======================\t=======================\terror_scaling: ', error_scaling)
+
+	# stream randoms for JK trimming, downsampled to 20x real density & labelled by jackknife cube
+	# (patch & redshift) -- only those inside cubes are kept
+	print('INITIAL jackknife random downsampling..')
+	reduce_factor = 20. * len(sample_z) / nrand
+	if reduce_factor > 0.95:
+		reduce_factor = 1.
+	extra_cols = ('color',)[:int(bool(args.SDSS))]
+	jkrandoms, random_labels = ds.stream_randoms(args.Random, extra_cols=extra_cols, zlims=zlims, accept=lambda z: reduce_factor, transform=shift, labeller=random_labeller)
+	jkrandoms = jkrandoms[:, [0, 1, 2, 4][:3 + len(extra_cols)]] # (ra, dec, z, [colour])
+
+	# filter empty patches
+	skinny_patch_cuts = [np.array( [ ( x.shape!=(0,) ) for x in sam ], dtype=bool ) for sam in jkData]
+	return jkData, jkWeights, error_scaling, jkrandoms, random_labels, skinny_patch_cuts
+
 class MyArgumentParser(argparse.ArgumentParser):
     def convert_arg_line_to_args(self, arg_line):
         print(arg_line)
@@ -1213,6 +1472,21 @@ if __name__ == "__main__":
 	type=int,
 	default=1)
 	parser.add_argument(
+	'-jk_regions',
+	type=str,
+	choices=['grid', 'area', 'count'],
+	default='grid',
+	help="jackknife regions: 'grid' = RA/Dec boxes of -patchSize (default), 'area' = -njk equal-area k-means regions (trained on the randoms), 'count' = -njk equal-galaxy-count k-means regions; -jk3d slices either into z-slabs")
+	parser.add_argument(
+	'-njk',
+	type=int,
+	default=50,
+	help='no. k-means jackknife regions, for -jk_regions area/count, default=50')
+	parser.add_argument(
+	'-jk_centres',
+	type=str,
+	help='file of k-means jackknife centres, reused if it exists or else saved there (default <outfile_root>/JKcentres_<jk_regions><njk>.txt)')
+	parser.add_argument(
 	'-occ_thresh',
 	help='specify patch-occupation threshold for SDSS survey-edge filtering; float between 0 - 1, default=0.99',
 	type=np.float32,
@@ -1328,8 +1602,30 @@ if __name__ == "__main__":
 	'-treecorr',
 	type=str,
 	help='use TreeCorr to measure wg+ -- give path to a configuration file with sections for (i) TreeCorr config, and (ii) treecorr_3DCF script kwargs')
+	parser.add_argument(
+	'-jk_workers',
+	type=int,
+	default=1,
+	help='no. worker processes over which jackknife regions are distributed (nproc is split between them); only with -jk_masks do workers share data in memory (the region-labelled catalogues, read once per worker) -- otherwise the JKsample files of each region are read afresh. Regions whose output is newer than their inputs are skipped, so interrupted runs resume. Default=1')
+	parser.add_argument(
+	'-binary_io',
+	type=int,
+	default=0,
+	help='1 = save patch & jackknife intermediates as binary (memory-mappable .npy) only, with ascii exported on demand for wcorr. Default=0')
+	parser.add_argument(
+	'-jk_masks',
+	type=int,
+	default=0,
+	help='1 = (with -treecorr) jackknife samples are index masks over one region-labelled catalogue per sample, correlated in memory -- no delete-one JKsample files are written. Default=0')
+	parser.add_argument(
+	'-analytic_jk',
+	type=int,
+	default=0,
+	help='1 = (with -treecorr) build all delete-one jackknife signals from one region-labelled single-pass measurement, instead of correlating each JK sample. Default=0')
 	args = parser.parse_args()
 	SHIFT = args.SHIFT
+	assert (not args.analytic_jk) or (args.treecorr is not None), "-analytic_jk requires -treecorr"
+	assert (not args.jk_masks) or (args.treecorr is not None), "-jk_masks requires -treecorr"
 
 	if args.Catalog.startswith('MUST'):
 		print(args.Catalog.split('_'))
@@ -1338,6 +1634,7 @@ if __name__ == "__main__":
 	print('=======================\tREADING CATALOG: %s'%args.Catalog)
 
 	catalog = RealCatalogue(args.Catalog, args.DEIMOS, args.rmagCut, args.SDSS, other=args.other, radians=args.radians, cols=args.cols, largePi=args.largePi, MICEdensity=args.MICEdens, SHIFT=SHIFT, PLOTNOW=args.plotNow)
+	catalog.binary_io = args.binary_io
 
 	if args.plotNow & (args.treecorr is not None):
 		print('PLOTTING TREECORR')
@@ -1449,55 +1746,16 @@ if __name__ == "__main__":
 
 	if args.bootstrap or args.jackknife:
 		print('COMPUTING SAMPLE COVARIANCES...')
-		if not args.largePiOnly:
-
-			# jkData.shape = (10 subsamples, N patches/cubes)
-			# random_cutter = N_patch array of functions, each to be applied to (ra, dec, z) of randoms
-			jkData, jkWeights, error_scaling, random_cutter = jk3d.resample_data(catalog.data, catalog.samplecuts, patchside=args.patchSize, zcut=args.zCut, do_sdss=(args.SDSS | args.other), do_3d=args.jk3d, cube_zdepth=args.cubeZdepth, largePi=0, bitmaskCut=args.bitmaskCut, occ_thresh=args.occ_thresh, SHIFT=SHIFT, cols=catalog.cols[:3])
-			print('jkData: ', jkData.shape)
-			print('jkWeights: ', jkWeights.shape, '\n', jkWeights)
-			print('=======================\t=======================\terror_scaling: ', error_scaling)
+		# jackknife region definition; k-means centres are saved by the first pass & reused by the next
+		jk_regions = {'regions':args.jk_regions, 'njk':args.njk,
+					'centres_file':(args.jk_centres or join(catalog.new_root, 'JKcentres_%s%i.txt'%(args.jk_regions, args.njk)))}
+		jkData, jkWeights, error_scaling, jkrandoms, random_labels, skinny_patch_cuts = jackknife_geometry(catalog, args, SHIFT, jk_regions)
+		Njkregions = len(jkData[0])
 
-			# read & downsample randoms, for JK trimming
-			jkrandoms = ds.read_randoms(args.Random)[:, :3]
-
-			if args.SDSS:
-				try:
-					rand_colour = fits.open(args.Random)[1].data['color']
-				except KeyError:
-					print("no randoms colour column -- skipping cut")
-					rand_colour = np.ones_like(jkrandoms.T[0])
-				jkrandoms = np.column_stack(( jkrandoms, rand_colour ))
-
-			if (not args.SDSS) & SHIFT:
-				random_ra = jkrandoms.T[0].copy()
-				shifted_dec = jkrandoms.T[1].copy()
-				G12 = (random_ra > 170) & (random_ra < 190)
-				shifted_dec = np.where(G12, shifted_dec + 1, shifted_dec)
-				jkrandoms[:, 1] = shifted_dec
-
-			zlabel = catalog.cols[2]
-			sample_z = catalog.data[zlabel]
-			print('INITIAL jackknife random downsampling..')
-			jkrandoms = ds.downsample(jkrandoms, sample_z, 1, 20) # 1 bin, target 20x real density
-			jkrandoms = jkrandoms[ (jkrandoms.T[2] >= sample_z.min()) & (jkrandoms.T[2] <= sample_z.max()) ]
-			ra, dec, z = jkrandoms.T[:3]
-
-			# merge random patch & redshift cuts
-			random_cut_bool = np.ones([len(random_cutter), len(jkrandoms)])
-			for i, edge_cut in enumerate(random_cutter):
-				# edge_cuts: 0 = patch-cut, 1 = z-cut
-				if args.jk3d:
-					random_cut_bool[i] = edge_cut[0](ra, dec, z) & edge_cut[1](ra, dec, z)
-				else:
-					random_cut_bool[i] = edge_cut(ra, dec, z)
-			Njkregions = len(jkData[0])
+		if not args.largePiOnly:
 
-			skinny_patch_cuts = []
 			for i,sam in enumerate(jkData):
-				# filter empty patches
-				skinny_patch_cut = np.array( [ ( x.shape!=(0,) ) for x in sam ], dtype=bool )
-				skinny_patch_cuts.append(skinny_patch_cut)
+				skinny_patch_cut = skinny_patch_cuts[i]
 				if i<4:
 					popd_sam = sam[ skinny_patch_cut ]
 				else: # if density sample
@@ -1516,19 +1774,21 @@ if __name__ == "__main__":
 					else: shapes=0
 					new_p,patch_z = catalog.cut_columns(p, args.H, args.flipe1, args.flipe2, args.Kneighbour, args.R0cut, shapes=shapes, mbias=args.mbias)
 					pDir = catalog.save_patches(new_p, catalog.new_root, catalog.labels[i], j, 0) # save_patches returns str(patchDir)
-			del jkData, popd_sam
+				catalog.save_cube_index(catalog.new_root, catalog.labels[i], (skinny_patch_cuts[i-4], skinny_patch_cut)[(i<4) | (i>=8)], 0)
+			jkData = None # largePi pass copies the patches
+			del popd_sam
 			gc.collect()
 
 			# make jackknife randoms (&reals) for norm (&swot)
-			print('making jackknife samples..') 				# MUST feed this fn randoms & random_cutter (.shape=(Ncubes, Nrandoms)) , or will BREAK!!
+			print('making jackknife samples..') 				# MUST feed this fn randoms & random_labels (.shape=(Nrandoms,)) , or will BREAK!!
 			gc.collect()
 			if args.densColours:
 				for radians_bool, paths_key in [(1, 'all'), (0, 'swot-all')]:
-					ds_jkfunc(catalog.new_root, random_cutter=random_cut_bool, empty_patches=skinny_patch_cuts, randoms=jkrandoms, radians=radians_bool, save_jks=1, jk_randoms=1, patch_str='patch', paths=paths_key, largePi=0, sdss=(args.SDSS | args.other), ccut=args.cCut)
+					ds_jkfunc(catalog.new_root, random_labels=random_labels, empty_patches=skinny_patch_cuts, randoms=jkrandoms, radians=radians_bool, save_jks=int(not args.jk_masks), jk_randoms=int(not args.jk_masks), patch_str='patch', paths=paths_key, largePi=0, sdss=(args.SDSS | args.other), ccut=args.cCut, save_labels=(args.analytic_jk | args.jk_masks), binary=args.binary_io)
 					gc.collect()
 			else:
 				for radians_bool, paths_key in [(1, 'dc0'), (0, 'swot-dc0')]:
-					ds_jkfunc(catalog.new_root, random_cutter=random_cut_bool, empty_patches=skinny_patch_cuts, randoms=jkrandoms, radians=radians_bool, save_jks=1, jk_randoms=1, patch_str='patch', paths=paths_key, largePi=0, sdss=(args.SDSS | args.other), ccut=args.cCut)
+					ds_jkfunc(catalog.new_root, random_labels=random_labels, empty_patches=skinny_patch_cuts, randoms=jkrandoms, radians=radians_bool, save_jks=int(not args.jk_masks), jk_randoms=int(not args.jk_masks), patch_str='patch', paths=paths_key, largePi=0, sdss=(args.SDSS | args.other), ccut=args.cCut, save_labels=(args.analytic_jk | args.jk_masks), binary=args.binary_io)
 					gc.collect()
 				#ds_jkfunc(catalog.new_root, random_cutter=random_cut_bool, empty_patches=skinny_patch_cuts, randoms=jkrandoms, radians=1, save_jks=1, jk_randoms=1, patch_str='patch', paths='all', largePi=0, sdss=args.SDSS, ccut=args.cCut)
 				#gc.collect()
@@ -1542,7 +1802,7 @@ if __name__ == "__main__":
 				elif args.jackknife:
 					jkWeights_pop = jkWeights[ skinny_patch_cuts[i] ]
 					print('===================\t %s reduced jkWeights: '%lab, jkWeights_pop.shape)
-					catalog.jackknife_patches(pDir)
+					catalog.jackknife_patches(pDir, jk_masks=args.jk_masks)
 
 					if args.unit_weights:
 						print('===================\t FORCING UNIT WEIGHTS FOR JACKKNIFE \t===================')
@@ -1554,74 +1814,36 @@ if __name__ == "__main__":
 					if args.makejk_only:
 						print('====================\t====================\t SKIPPING JACKKNIFE CORRELATIONS ====================\t====================\t')
 					else:
-						catalog.wcorr_jackknife(pDir, args.rpBins, args.rpLims, args.losBins, args.losLim, args.nproc, 0, args.densColours, treecorr=args.treecorr, **top_tc_config)
+						catalog.wcorr_jackknife(pDir, args.rpBins, args.rpLims, args.losBins, args.losLim, args.nproc, 0, args.densColours, treecorr=args.treecorr, analytic=args.analytic_jk, jk_masks=args.jk_masks, jk_workers=args.jk_workers, **top_tc_config)
 					catalog.jackknife(pDir, jkWeights_pop, error_scaling, 0)
 			np.savetxt(join(catalog.new_root, 'JK_subsample_numbers.txt'), np.array(jknumbers), header=jkn_header, fmt='%i')
 
 		if args.largePi:
-			jkData, jkWeights, error_scaling, random_cutter = jk3d.resample_data(catalog.data, catalog.samplecuts, patchside=args.patchSize, zcut=args.zCut, do_sdss=(args.SDSS | args.other), do_3d=args.jk3d, cube_zdepth=args.cubeZdepth, largePi=1, bitmaskCut=args.bitmaskCut, SHIFT=SHIFT, cols=catalog.cols[:3])
-			Njkregions = len(jkData[0])
-
-			# read & downsample randoms, for JK trimming
-			jkrandoms = ds.read_randoms(args.Random)[:, :3]
-
-			if args.SDSS:
-				try:
-					rand_colour = fits.open(args.Random)[1].data['color']
-				except KeyError:
-					print("no randoms colour column -- skipping cut")
-					rand_colour = np.ones_like(jkrandoms.T[0])
-				jkrandoms = np.column_stack(( jkrandoms, rand_colour ))
-
-			if (not args.SDSS) & SHIFT:
-				random_ra = jkrandoms.T[0].copy()
-				shifted_dec = jkrandoms.T[1].copy()
-				G12 = (random_ra > 170) & (random_ra < 190)
-				shifted_dec = np.where(G12, shifted_dec + 1, shifted_dec)
-				jkrandoms[:, 1] = shifted_dec
-
-			zlabel = catalog.cols[2]
-			sample_z = catalog.data[zlabel]
-			print('INITIAL jackknife random downsampling..')
-			jkrandoms = ds.downsample(jkrandoms, sample_z, 1, 20) # 1 bin, target 20x real density
-			jkrandoms = jkrandoms[ (jkrandoms.T[2] >= sample_z.min()) & (jkrandoms.T[2] <= sample_z.max()) ]
-			ra, dec, z = jkrandoms.T[:3]
-
-			# merge random patch & redshift cuts
-			random_cut_bool = np.ones([len(random_cutter), len(jkrandoms)])
-			for i, edge_cut in enumerate(random_cutter):
-				# edge_cuts: 0 = patch-cut, 1 = z-cut
-				if args.jk3d:
-					random_cut_bool[i] = edge_cut[0](ra, dec, z) & edge_cut[1](ra, dec, z)
-				else:
-					random_cut_bool[i] = edge_cut(ra, dec, z)
-			Njkregions = len(jkData[0])
-
-			skinny_patch_cuts = []
-			for i,sam in enumerate(jkData):
-
-				skinny_patch_cut = np.array( [ ( x.shape!=(0,) ) for x in sam ], dtype=bool )
-				skinny_patch_cuts.append(skinny_patch_cut)
-				if (i<4) | (i>=8):
-					popd_sam = sam[ skinny_patch_cut ]
+			for i,skinny_patch_cut in enumerate(skinny_patch_cuts):
+				if (args.zCut==None) & ('lowZ' in catalog.labels[i]): continue
+				if jkData is None: # patches saved by the standard pass
+					pDir = catalog.copy_patches(catalog.new_root, catalog.labels[i])
 				else:
-					popd_sam = sam[ skinny_patch_cuts[i-4] ]
-
-				for j,p in enumerate(popd_sam):
-					if (args.zCut==None) & ('lowZ' in catalog.labels[i]): continue
-					if i<4: shapes=1
-					else: shapes=0
-					new_p,patch_z = catalog.cut_columns(p, args.H, args.flipe1, args.flipe2, args.Kneighbour, args.R0cut, shapes=shapes, mbias=args.mbias)
-					pDir = catalog.save_patches(new_p, catalog.new_root, catalog.labels[i], j, 1) # pDir (patch/cube directory) appended with _largePi
+					sam = jkData[i]
+					if (i<4) | (i>=8):
+						popd_sam = sam[ skinny_patch_cut ]
+					else:
+						popd_sam = sam[ skinny_patch_cuts[i-4] ]
+
+					for j,p in enumerate(popd_sam):
+						if i<4: shapes=1
+						else: shapes=0
+						new_p,patch_z = catalog.cut_columns(p, args.H, args.flipe1, args.flipe2, args.Kneighbour, args.R0cut, shapes=shapes, mbias=args.mbias)
+						pDir = catalog.save_patches(new_p, catalog.new_root, catalog.labels[i], j, 1) # pDir (patch/cube directory) appended with _largePi
+					catalog.save_cube_index(catalog.new_root, catalog.labels[i], (skinny_patch_cuts[i-4], skinny_patch_cut)[(i<4) | (i>=8)], 1)
 				if (3<i<8) | ((i>=8) & args.densColours): # density samples ; gen jk samples
-					if (args.zCut==None) & ('lowZ' in catalog.labels[i]): continue
-					catalog.jackknife_patches(pDir) # need this function call for WEIGHTS
+					catalog.jackknife_patches(pDir, jk_masks=args.jk_masks) # need this function call for WEIGHTS
 
 			# no swot-files for largePi - can't set lower Pi-limit
 			if args.densColours:
-				ds_jkfunc(catalog.new_root, random_cutter=random_cut_bool, empty_patches=skinny_patch_cuts, randoms=jkrandoms, radians=1, save_jks=0, jk_randoms=1, patch_str='patch', paths='all', largePi=1, sdss=(args.SDSS | args.other), ccut=args.cCut)
+				ds_jkfunc(catalog.new_root, random_labels=random_labels, empty_patches=skinny_patch_cuts, randoms=jkrandoms, radians=1, save_jks=0, jk_randoms=int(not args.jk_masks), patch_str='patch', paths='all', largePi=1, sdss=(args.SDSS | args.other), ccut=args.cCut, save_labels=(args.analytic_jk | args.jk_masks), binary=args.binary_io)
 			else:
-				ds_jkfunc(catalog.new_root, random_cutter=random_cut_bool, empty_patches=skinny_patch_cuts, randoms=jkrandoms, radians=1, save_jks=1, jk_randoms=1, patch_str='patch', paths='dc0', largePi=1, sdss=(args.SDSS | args.other), ccut=args.cCut)
+				ds_jkfunc(catalog.new_root, random_labels=random_labels, empty_patches=skinny_patch_cuts, randoms=jkrandoms, radians=1, save_jks=int(not args.jk_masks), jk_randoms=int(not args.jk_masks), patch_str='patch', paths='dc0', largePi=1, sdss=(args.SDSS | args.other), ccut=args.cCut, save_labels=(args.analytic_jk | args.jk_masks), binary=args.binary_io)
 
 			jknumbers, jkn_header = [], ''
 			for i, lab in enumerate(catalog.labels[:4]):
@@ -1631,11 +1853,11 @@ if __name__ == "__main__":
 				elif args.jackknife:
 					jkWeights_pop = jkWeights[ skinny_patch_cuts[i] ]
 					print('===================\treduced jkWeights: ', jkWeights_pop.shape)
-					catalog.jackknife_patches(pDir)
+					catalog.jackknife_patches(pDir, jk_masks=args.jk_masks)
 					np.savetxt(join(catalog.new_root, 'jkWeights_%s_largePi.txt'%lab), jkWeights_pop, header='%s largePi\n%i samples'%(lab, len(jkWeights_pop)))
 					jknumbers.append(len(jkWeights_pop))
 					jkn_header += '%s\t'%lab
-					catalog.wcorr_jackknife(pDir, args.rpBins, args.rpLims, args.losBins, args.losLim, args.nproc, 1, args.densColours, treecorr=args.treecorr, **top_tc_config)
+					catalog.wcorr_jackknife(pDir, args.rpBins, args.rpLims, args.losBins, args.losLim, args.nproc, 1, args.densColours, treecorr=args.treecorr, analytic=args.analytic_jk, jk_masks=args.jk_masks, jk_workers=args.jk_workers, **top_tc_config)
 					catalog.jackknife(pDir, jkWeights_pop, error_scaling, 1)
 			np.savetxt(join(catalog.new_root, 'JK_subsample_numbers_largePi.txt'), np.array(jknumbers), header=jkn_header+'\nlargePi', fmt='%i')
 
@@ -1667,6 +1889,7 @@ if __name__ == "__main__":
 
 	if args.Random != None:
 		catalog2 = RandomCatalogue(args.Random, args.densColours, args.SDSS, SHIFT=SHIFT)
+		catalog2.binary_io = args.binary_io
 		randoms_3col = np.column_stack(( catalog2.data[catalog2.headers['ra']], catalog2.data[catalog2.headers['dec']], catalog2.data[catalog2.headers['z']] ))
 
 		for samz_k in samz_keys:
@@ -1734,6 +1957,7 @@ if __name__ == "__main__":
 			print(rc)
 
 		if args.treecorr:
+			tc_combos, tc_outfs = [], []
 			for i in range(len(adjusted_combos)):
 				densf, dc, shapesf, sc, outf = adjusted_combos[i]
 				rdensf, rdc, rshapesf, rsc, routf = rand_combos[i]
@@ -1742,9 +1966,11 @@ if __name__ == "__main__":
 				rdensf = join(catalog.new_root, rdensf)
 				rshapesf = join(catalog.new_root, rshapesf)
 				outf = join(catalog.new_root, 'wcorr_'+outf+'.dat')
-				# densf, shapesf, drandf, srandf, config, outfile,
-				# estim='PW1', np=16, **kwargs(nbins_rpar=30, random_oversampling=10., verbosity=1, {load_RRs, save_RRs -- for PW2 only})
-				catalog.run_treecorr(densf, shapesf, rdensf, rshapesf, top_tc_config['tc_config'], outf, np=args.nproc, **top_tc_config['tc3dcf_kwargs'])
+				tc_combos.append((densf, shapesf, rdensf, rshapesf))
+				tc_outfs.append(outf)
+			# all combos in one process; shared density/random catalogues are read & tree-built once
+			# **kwargs(nbins_rpar=30, random_oversampling=10., verbosity=1, random_seed, {rr_store -- for PW2 only})
+			catalog.run_treecorr_batch(tc_combos, top_tc_config['tc_config'], tc_outfs, args.nproc, **top_tc_config['tc3dcf_kwargs'])
 
 			if args.plot:
 				os.system(('python /share/splinter/hj/PhD/catalog_sampler.py -Catalog %s '%args.Catalog +
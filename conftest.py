@@ -0,0 +1 @@
+# repo root conftest: puts the top-level modules on sys.path for tests/
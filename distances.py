@@ -0,0 +1,47 @@
+from __future__ import print_function, division
+import numpy as np
+from astropy.cosmology import FlatLambdaCDM as FLCDM
+from scipy.interpolate import InterpolatedUnivariateSpline
+MICEcosmo = FLCDM(Om0=0.25, H0=70, Ob0=0.044)
+
+_tables = {}
+
+def get_distances(cosmo=MICEcosmo, zmax=10., ngrid=10000):
+	# shared Distances table per cosmology (& grid), built on first call
+	key = (repr(cosmo), zmax, ngrid)
+	if key not in _tables:
+		_tables[key] = Distances(cosmo, zmax=zmax, ngrid=ngrid)
+	return _tables[key]
+
+class Distances:
+	"""
+	Cubic-spline lookups of comoving distance chi(z), its inverse z(chi), dchi/dz and the
+	distance modulus for one cosmology, from a dense grid on 0 <= z <= zmax -- one astropy
+	integration per grid, instead of one per call. Distances are in Mpc/h, or Mpc with h_units=0.
+	"""
+	def __init__(self, cosmo=MICEcosmo, zmax=10., ngrid=10000):
+		self.cosmo = cosmo
+		self.h = cosmo.h
+		self.z_grid = np.linspace(0., zmax, ngrid)
+		self.chi_grid = cosmo.comoving_distance(self.z_grid).value * self.h
+		self._chi = InterpolatedUnivariateSpline(self.z_grid, self.chi_grid)
+		self._z = InterpolatedUnivariateSpline(self.chi_grid, self.z_grid)
+		self._dchi = self._chi.derivative()
+		# distance modulus diverges at z = 0
+		self._distmod = InterpolatedUnivariateSpline(self.z_grid[1:], cosmo.distmod(self.z_grid[1:]).value)
+
+	def _units(self, h_units):
+		return (1. / self.h, 1.)[int(bool(h_units))]
+
+	def chi(self, z, h_units=1):
+		return self._chi(z) * self._units(h_units)
+
+	def z(self, chi, h_units=1):
+		return self._z(np.asarray(chi) / self._units(h_units))
+
+	def dchi_dz(self, z, h_units=1):
+		return self._dchi(z) * self._units(h_units)
+
+	def distmod(self, z):
+		return self._distmod(z)
+
@@ -2,14 +2,17 @@ from __future__ import print_function, division
 import numpy as np
 from astropy.io import fits, ascii
 import sys
+import re
+import itertools
 from os import listdir, mkdir
 from os.path import basename, normpath, join, dirname, isdir
 import argparse
 from joblib import Parallel, delayed
 import gc
 import multiprocessing
-from astropy.cosmology import FlatLambdaCDM as FLCDM
-MICEcosmo = FLCDM(Om0=0.25, H0=70, Ob0=0.044)
+import healpy as hp
+import catalog_io
+from distances import get_distances
 
 def betwixt((re1,re2,de1,de2,ze1,ze2)):
         def make_cut(ra,dec,z):
@@ -36,6 +39,82 @@ def read_randoms(path, cols=None, weights=None):
 	print('done.')
 	return randoms
 
+def iter_randoms(path, cols=None, extra_cols=(), chunksize=2**21):
+	# (ra, dec, z, w=1, extra_cols..) chunks of the random catalogue at path, chunksize rows at a time --
+	# FITS memory-mapped, ascii parsed a slice of lines at a time; missing extra columns are ones
+	if '.fits' in path:
+		columns = ('RA','DEC','Z')
+		if cols!=None:
+			columns = cols
+		fd = fits.open(path, memmap=True)
+		data = fd[1].data
+		names = [n.lower() for n in data.columns.names]
+		missing = [c for c in extra_cols if c.lower() not in names]
+		if len(missing) != 0:
+			print('no randoms %s column(s) -- filled with ones'%missing)
+		for i in range(0, len(data), chunksize):
+			chunk = data[i:i+chunksize]
+			ones = np.ones(len(chunk))
+			yield np.column_stack([chunk[c] for c in columns] + [ones] + [(chunk[c] if c not in missing else ones) for c in extra_cols])
+		fd.close()
+	else:
+		columns = (0,1,2)
+		if cols!=None:
+			columns = cols
+		with open(path) as f:
+			while True:
+				lines = list(itertools.islice(f, chunksize))
+				if len(lines) == 0:
+					break
+				data = np.loadtxt(lines, ndmin=2)
+				if data.size == 0: # comments only
+					continue
+				ones = np.ones(len(data))
+				yield np.column_stack([data[:, c] for c in columns] + [ones] + [data[:, c] for c in extra_cols])
+
+def count_randoms(path, cols=None, zlims=None, chunksize=2**21):
+	# no. randoms (within zlims), streamed
+	n = 0
+	for chunk in iter_randoms(path, cols=cols, chunksize=chunksize):
+		z = chunk[:, 2]
+		n += len(z) if zlims is None else np.sum((z >= zlims[0]) & (z <= zlims[1]))
+	return n
+
+def stream_randoms(path, cols=None, extra_cols=(), zlims=None, accept=None, transform=None, labeller=None, chunksize=2**21, seed=None):
+	"""
+	read the random catalogue at path chunk-by-chunk (iter_randoms), materialising only the rows which
+	survive each of (if given):
+	zlims = (zmin, zmax) trimming,
+	accept(z) = probability of keeping each random, for n(z) downsampling,
+	transform(chunk) = in-place coordinate change (e.g. GAMA G12 dec-shift),
+	labeller(ra, dec, z) >= 0, i.e. inside the footprint/jackknife regions
+	returns survivors (ra, dec, z, w, extra_cols..), and their labels if labeller
+	"""
+	rng = np.random.RandomState(seed)
+	kept, kept_labels, ntot = [], [], 0
+	for chunk in iter_randoms(path, cols=cols, extra_cols=extra_cols, chunksize=chunksize):
+		ntot += len(chunk)
+		z = chunk[:, 2]
+		keep = np.ones(len(chunk), dtype=bool)
+		if zlims is not None:
+			keep &= (z >= zlims[0]) & (z <= zlims[1])
+		if accept is not None:
+			keep &= rng.random_sample(len(chunk)) < accept(z)
+		chunk = chunk[keep]
+		if transform is not None:
+			chunk = transform(chunk)
+		if labeller is not None:
+			labels = labeller(chunk[:, 0], chunk[:, 1], chunk[:, 2])
+			inside = labels >= 0
+			chunk = chunk[inside]
+			kept_labels.append(labels[inside])
+		kept.append(chunk)
+	randoms = np.concatenate(kept) if len(kept) != 0 else np.empty((0, 4 + len(extra_cols)))
+	print('streamed randoms: kept %s / %s'%(len(randoms), ntot))
+	if labeller is not None:
+		return randoms, np.concatenate(kept_labels) if len(kept) != 0 else np.empty(0, dtype=int)
+	return randoms
+
 def read_reals(path, cols=None, weights=None):
 	print('reading reals...')
 	if '.fits' in path:
@@ -110,32 +189,69 @@ def save_newrandoms(new_randoms, path, zrange=None, outfile=None, rad=0):
 		new_randoms = np.column_stack((new_randoms, np.ones_like(new_randoms.T[0])))
         	ascii.write(new_randoms,rand_out,delimiter='\t',names=['# RA','DEC','z','weight'], overwrite=1)
 
-def find_limits(reals):
-	ramin, decmin, zmin = (reals.T[i].min() for i in range(3))
-        ramax, decmax, zmax = (reals.T[i].max() for i in range(3))
-        xyzrange = ( ramax-ramin, decmax-decmin, zmax-zmin )
-        minima = ( ramin, decmin, zmin )
-	return xyzrange, minima
-
-def make_randoms(reals, starting_factor=25):
-	xyzrange, minima = find_limits(reals)
-	real_size = reals.shape[0]
-        # randomly, densely populate the survey cuboid
-        print('laying down random points...')
-        xmax,ymax,zmax = xyzrange
-        X,Y,z = map(lambda x: np.random.random(starting_factor * real_size) * x, [xmax,ymax,zmax])
-	X += minima[0]
-	Y += minima[1]
-	z += minima[2]
-        rand_cat = np.column_stack((X,Y,z))
-        return rand_cat
-
-def trim_randoms(randoms, reals, max_sep=0.1):
-	# idea is;
-	# identify random points near/beyond real survey edges (somehow) = rpoints
-	# for each rpoint, identify nearest real galaxy, and its distance from the rpoint
-	# if >max_sep, remove rpoint ---> CPU heavvvyyyy??
-	pass
+def footprint_mask(ra, dec, nside=1024):
+	# HEALPix (ring) footprint map of the pixels occupied by (ra, dec) [deg], as functions.radec_to_map
+	return np.bincount(hp.ang2pix(nside, ra, dec, lonlat=True), minlength=hp.nside2npix(nside)) != 0
+
+def iter_footprint_randoms(mask, n, z=None, z_weights=None, nz=None, polygon=None, nside=1024, nest=False, chunksize=2**22, seed=None):
+	"""
+	n area-uniform randoms (ra, dec [deg], z, w=1) inside a footprint, in chunks of <= chunksize rows
+	mask: HEALPix map (or path to one, e.g. from make_pau_mask.py/functions.path_to_map), with values in
+	[0, 1] = covered fraction of each pixel; pixels are drawn by covered area, then a random nested
+	sub-pixel at nside=2^29 (~0.4 mas) within each, so points are uniform on the sphere
+	polygon: (ra, dec) vertices [deg] of a footprint (in the ra/dec plane), alone (on an nside grid)
+	or intersected with mask
+	redshifts are drawn from z (e.g. the real redshifts, weighted by z_weights), or from nz =
+	(z edges, counts) uniformly within bins, else set to 0
+	"""
+	rng = np.random.RandomState(seed)
+	if isinstance(mask, str):
+		mask = hp.read_map(mask, nest=nest)
+	path = None
+	if polygon is not None:
+		from matplotlib.path import Path
+		pra, pdec = np.asarray(polygon, dtype=float).T
+		if mask is not None:
+			nside = hp.npix2nside(len(mask))
+		poly_mask = np.zeros(hp.nside2npix(nside))
+		poly_mask[hp.query_polygon(nside, hp.ang2vec(pra, pdec, lonlat=True), inclusive=True, nest=nest)] = 1.
+		mask = poly_mask if mask is None else np.asarray(mask, dtype=float) * poly_mask
+		path = Path(np.column_stack((pra, pdec)))
+
+	nside = hp.npix2nside(len(mask))
+	pix = np.where(mask > 0)[0]
+	p_pix = mask[pix] / np.sum(mask[pix], dtype=float)
+	if not nest:
+		pix = hp.ring2nest(nside, pix)
+	pix = np.asarray(pix, dtype=np.int64)
+	nsub = 4**(29 - int(np.log2(nside))) # nested sub-pixels of nside=2^29 per pixel
+
+	if z is not None:
+		p_z = None if z_weights is None else np.asarray(z_weights, dtype=float) / np.sum(z_weights)
+		draw_z = lambda m: rng.choice(z, size=m, p=p_z)
+	elif nz is not None:
+		edges, counts = np.asarray(nz[0], dtype=float), np.asarray(nz[1], dtype=float)
+		def draw_z(m):
+			b = rng.choice(len(counts), size=m, p=counts / counts.sum())
+			return edges[b] + rng.random_sample(m) * np.diff(edges)[b]
+	else:
+		draw_z = lambda m: np.zeros(m)
+
+	ndone = 0
+	while ndone < n:
+		m = min(chunksize, n - ndone)
+		subpix = pix[rng.choice(len(pix), size=m, p=p_pix)] * nsub + rng.randint(0, nsub, size=m, dtype=np.int64)
+		ra, dec = hp.pix2ang(2**29, subpix, nest=True, lonlat=True)
+		if path is not None:
+			inside = path.contains_points(np.column_stack((ra, dec)))
+			ra, dec = ra[inside], dec[inside]
+		ndone += len(ra)
+		yield np.column_stack((ra, dec, draw_z(len(ra)), np.ones(len(ra))))
+
+def footprint_randoms(mask, n, **kwargs):
+	# n footprint randoms (ra, dec [deg], z, w=1) -- see iter_footprint_randoms
+	print('laying down %s footprint random points...'%n)
+	return np.concatenate(list(iter_footprint_randoms(mask, n, **kwargs)))
 
 def unit_check(cat, give_back='degrees', tag=''):
 	assert give_back in ['degrees', 'radians'], 'give_back kwarg must == "degrees" | "radians"'
@@ -155,49 +271,83 @@ def unit_check(cat, give_back='degrees', tag=''):
 	else:
 		return cat
 
-def downsample(randoms, sample_z, nbin=1, target_nz=10):
-	# downsample artificial randoms to match mocks' N(z)
+class NzAcceptance:
+	"""
+	Acceptance probability of randoms against redshift, for matching their n(z) to target_nz x the
+	(weighted) real n(z) -- per bin of the binned ratio (bins = N or edges, as np.histogram), or on a
+	fine grid of Gaussian-smoothed n(z)s if kernel = smoothing sigma_z, in which case bins is ignored
+	for nfine bins, and the kernel truncated at +/-4 sigma or the grid width, whichever is narrower.
+	Callable on random redshifts, so a table built once can downsample later random chunks
+	(stream_randoms(accept=..)).
+	"""
+	def __init__(self, random_z, sample_z, bins=1, target_nz=10, weights=None, kernel=None, nfine=200):
+		if kernel is not None:
+			bins = nfine
+		rand_nz, self.edges = np.histogram(random_z, bins=bins)
+		real_nz = np.histogram(sample_z, bins=self.edges, weights=weights)[0]
+		if weights is not None:
+			# weighted counts normalised to the number of reals, so target_nz stays randoms per real
+			real_nz = real_nz * (len(sample_z) / np.sum(weights))
+		self.real_Nz = real_nz / real_nz.sum()
+		if kernel is not None:
+			sig = kernel / np.diff(self.edges).mean()
+			# no longer than the grid, so the smoothed n(z)s stay on self.edges
+			half = min(int(4*sig), (len(rand_nz) - 1) // 2)
+			x = np.arange(-half, half + 1)
+			gauss = np.exp(-0.5 * (x / sig)**2)
+			smooth = lambda h: np.convolve(h, gauss / gauss.sum(), mode='same')
+			rand_nz, real_nz = smooth(rand_nz), smooth(real_nz)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			reduce_factor = np.nan_to_num(target_nz * (real_nz / rand_nz))
+		# bins with too few randoms are kept whole
+		low = reduce_factor > 0.95
+		if low.any():
+			print('random-z bins %s / %s dN/dz too low..!'%(np.where(low)[0], len(reduce_factor)))
+		self.p = np.where(low, 1., reduce_factor)
+
+	def __call__(self, z):
+		# acceptance of each random; 0 outside (edges[0], edges[-1]]
+		i = np.digitize(z, self.edges, right=True) - 1
+		inside = (i >= 0) & (i < len(self.p))
+		return np.where(inside, self.p[np.clip(i, 0, len(self.p) - 1)], 0.)
+
+	def report(self, new_z):
+		# achieved real/random N(z) per bin, for downsampled random redshifts new_z
+		rand_Nz = np.histogram(new_z, bins=self.edges)[0] / len(new_z)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			ratio = self.real_Nz / rand_Nz
+		print('real/random N(z) (should be ~1):\n', ratio)
+		return ratio
+
+def downsample(randoms, sample_z, nbin=1, target_nz=10, weights=None, kernel=None, table=None, return_table=0):
+	# downsample artificial randoms to match mocks' N(z), in one pass -- see NzAcceptance
+	# weights: of real galaxies; table: NzAcceptance from an earlier call, to reuse
 	assert abs(randoms.T[2].max() - sample_z.max()) < sample_z.max(), "redshift/comoving distance mismatch! randoms.max() = %g, reals.max() = %g"%(randoms.T[2].max(), sample_z.max())
-	#import pdb ; pdb.set_trace()
 
 	# trim edges of z-distn
 	random_z = randoms[:,2]
-	zmin, zmax = sample_z.min(), sample_z.max() 
+	zmin, zmax = sample_z.min(), sample_z.max()
 	ztrim = (random_z >= zmin) & (random_z <= zmax)
 	print('trimming random-z edges to reals..')
 	new_randoms, random_z = randoms[ztrim], random_z[ztrim]
 	print('sample z minmax: %s, %s'%(sample_z.min(), sample_z.max()))
 	print('random z minmax: %s, %s'%(random_z.min(), random_z.max()))
 
-	rand_nz, zbins = np.histogram(random_z, bins=nbin)
-	real_nz = np.histogram(sample_z, bins=zbins)[0]
-	reduce_factor = target_nz*(real_nz/rand_nz)
-	reduce_factor = np.nan_to_num(reduce_factor)
-
 	print('downsampling random points...')
-	nztune = np.zeros_like(random_z, dtype=bool)
-	rand_num = np.random.random(size=len(random_z))
-	for i in range(len(rand_nz)):
-		bincut = (zbins[i] < random_z) & (random_z <= zbins[i+1])
-		if (reduce_factor[i] <= 0.95):
-			nzcut = (rand_num >= 0.05) & (rand_num <= reduce_factor[i] + 0.05)
-			nzbincut = bincut & nzcut
-		else:
-			print('random-z bin %s / %s dN/dz too low..!'%(i, len(reduce_factor)))
-			nzbincut = bincut
-		nztune = np.where(nzbincut, True, nztune)
-
+	if table is None:
+		table = NzAcceptance(random_z, sample_z, bins=nbin, target_nz=target_nz, weights=weights, kernel=kernel)
+	nztune = np.random.random(size=len(random_z)) < table(random_z)
 	new_randoms = new_randoms[nztune]
-	new_rand_z = new_randoms[:,2]
-	rand_Nz = np.histogram(new_rand_z, bins=zbins)[0] / len(new_rand_z)
-	real_Nz = real_nz/len(sample_z)
-	print('real/random N(z) (should be ~1):\n',real_Nz/rand_Nz)
+	table.report(new_randoms[:,2])
 
 	print('done.')
+	if return_table:
+		return new_randoms, table
 	return new_randoms
 
-def para_jk_save(jkdir, patches, save_jks, jk_randoms, randoms, units, names, rand_names, j):
+def para_jk_save(jkdir, patches, save_jks, jk_randoms, randoms, units, names, rand_names, j, binary=0, rand_labels=None, region=None):
 	# define JK samples, real and/or random, 1-per-patch
+	# rand_labels, region: region number of each random & of patch j -- else randoms are cut by patch limits
 	jksample_str = join(jkdir, 'JKsample%s.asc'%(str(j).zfill(3)))
 	jk_rand_str = join(jkdir, 'rand_JKsample%s.asc'%(str(j).zfill(3)))
 
@@ -206,43 +356,79 @@ def para_jk_save(jkdir, patches, save_jks, jk_randoms, randoms, units, names, ra
 		jksample = np.concatenate(del_one_patches)
 		jksample = unit_check(jksample, give_back=units, tag='JKsample%s'%(str(j).zfill(3)))
 
-		ascii.write(jksample, jksample_str, names=names, delimiter='\t', overwrite=1)
+		catalog_io.write(jksample_str, jksample, names=names, binary=binary)
 		del jksample
 		gc.collect()
 
 	if jk_randoms:
-		# find limits of patch
-		patch_lims = np.array([( x.min(), x.max() ) for x in patches[j].T[:3]]).flatten()
-
-		# match units with randoms
-		if all(patches[j].T[:2].flatten() <= 2*np.pi) & ( not all(randoms.T[:2].flatten() <= 2*np.pi) ):
-			patch_lims[:4] *= (180./np.pi)
-		elif ( not all(patches[j].T[:2].flatten() <= 2*np.pi) )  &  all(randoms.T[:2].flatten() <= 2*np.pi):
-			patch_lims[:4] *= (np.pi/180.)
-
 		# reverse patch-cut for delete-1 jackknife
-		patch_cut = betwixt( tuple(patch_lims) )
-		jkrand_cut = ~patch_cut(randoms.T[0], randoms.T[1], randoms.T[2])
+		if rand_labels is not None:
+			jkrand_cut = rand_labels != region
+		else:
+			patch_cut = betwixt( patch_limits(patches[j], randoms) )
+			jkrand_cut = ~patch_cut(randoms.T[0], randoms.T[1], randoms.T[2])
 
 		jkrands = randoms[jkrand_cut]
 		jkrands = unit_check(jkrands, give_back=units, tag='rand_JKsample%s'%(str(j).zfill(3)))
+		jkrands = match_columns(jkrands, rand_names)
 
-		# match N columns with reals
-		Nmissing_cols = len(rand_names) - jkrands.shape[1]
-		if Nmissing_cols>0:
-			dummy_columns = np.ones([jkrands.shape[0], Nmissing_cols])
-			jkrands = np.column_stack((jkrands, dummy_columns))
-		elif Nmissing_cols<0:
-			jkrands = jkrands[:, :len(rand_names)]
-
-		ascii.write(jkrands, jk_rand_str, names=rand_names, delimiter='\t', overwrite=1)
+		catalog_io.write(jk_rand_str, jkrands, names=rand_names, binary=binary)
 		del jkrands
 		gc.collect()
 
-def make_jks(wdir, randoms=None, random_cutter=None, empty_patches=None, radians=0, save_jks=0, jk_randoms=1, patch_str='patch', paths='all', largePi=0, sdss=0, ccut=None):
+def patch_limits(patch, randoms):
+	# (ra, dec, z) limits of patch, in the angular units of randoms
+	patch_lims = np.array([( x.min(), x.max() ) for x in patch.T[:3]]).flatten()
+	if all(patch.T[:2].flatten() <= 2*np.pi) & ( not all(randoms.T[:2].flatten() <= 2*np.pi) ):
+		patch_lims[:4] *= (180./np.pi)
+	elif ( not all(patch.T[:2].flatten() <= 2*np.pi) )  &  all(randoms.T[:2].flatten() <= 2*np.pi):
+		patch_lims[:4] *= (np.pi/180.)
+	return tuple(patch_lims)
+
+def match_columns(cat, names):
+	# match N columns with reals
+	Nmissing_cols = len(names) - cat.shape[1]
+	if Nmissing_cols>0:
+		dummy_columns = np.ones([cat.shape[0], Nmissing_cols])
+		cat = np.column_stack((cat, dummy_columns))
+	elif Nmissing_cols<0:
+		cat = cat[:, :len(names)]
+	return cat
+
+def patch_number(patch_file):
+	# region number from patch file name, <label>%03dpatch.asc
+	return int(re.search(r'(\d+)patch', basename(patch_file)).group(1))
+
+def save_jk_labels(jkdir, patches, patch_files, randoms, units, rand_names, binary=0, rand_labels=None):
+	# save randoms with labels of the patch/cube containing them (-1 = none), numbered in sorted
+	# patch-file order -- for analytic jackknifing in treecorr_3DCF.compute_w(jk_labels=..)
+	# rand_labels: region number (as patch_number) of each random -- else first patch whose limits contain it
+	order = np.argsort(patch_files)
+	if rand_labels is not None:
+		numbers = np.array([patch_number(patch_files[p]) for p in order])
+		lookup = -np.ones(max(numbers.max(), rand_labels.max()) + 2, dtype=int)
+		lookup[numbers] = np.arange(len(numbers))
+		labels = lookup[rand_labels] # -1 indexes the final -1
+	else:
+		labels = -np.ones(len(randoms), dtype=int)
+		for j, p in enumerate(order):
+			patch_cut = betwixt( patch_limits(patches[p], randoms) )
+			in_patch = patch_cut(randoms.T[0], randoms.T[1], randoms.T[2]) & (labels < 0)
+			labels[in_patch] = j
+
+	jkrands = unit_check(randoms, give_back=units, tag='rand_labelled')
+	jkrands = match_columns(jkrands, rand_names)
+	catalog_io.write(join(jkdir, 'rand_labelled.asc'), jkrands, names=rand_names, binary=binary)
+	np.savetxt(join(jkdir, 'rand_labelled_jk.txt'), labels, fmt='%i')
+	print('labelled randoms: %s / %s in %s regions'%((labels >= 0).sum(), len(labels), len(patches)))
+
+def make_jks(wdir, randoms=None, random_labels=None, empty_patches=None, radians=0, save_jks=0, jk_randoms=1, patch_str='patch', paths='all', largePi=0, sdss=0, ccut=None, save_labels=0, binary=0):
+	# random_labels is the cube number of each random (jackknife3d.resample_data random_labeller), -1 = none
 	# empty_patches is boolean array of length uncut-Npatches
 	# True where all skinny-patch cuts are met
 	# index 0-3: shapes, 4-7: densities, 8-9: all-colour densities
+	# save_labels: also save one region-labelled random catalogue per sample, for analytic jackknifing
+	# binary: save JK samples as binary only (catalog_io)
 	patch_str = patch_str.split('*')
 	units = ['degrees', 'radians'][radians]
 	pathdict = {'all': ['highZ_Red_UnMasked', 'highZ_Blue_UnMasked', 'lowZ_Red_UnMasked', 'lowZ_Blue_UnMasked'],
@@ -252,10 +438,11 @@ def make_jks(wdir, randoms=None, random_cutter=None, empty_patches=None, radians
 		     'shapes': ['highZ_Red', 'highZ_Blue', 'lowZ_Red', 'lowZ_Blue']}
 
 	samples = pathdict[paths]
-	_randoms_ = randoms.copy()
+	_randoms_ = randoms
 	if (paths not in ['swot-all', 'swot-dc0']) & (all(_randoms_.T[2] <= 2.)):
 		print('converting random redshifts to comoving distances [Mpc/h]..')
-		_randoms_[:,2] = MICEcosmo.comoving_distance(_randoms_.T[2]) * 0.7 # * h
+		_randoms_ = randoms.copy()
+		_randoms_[:,2] = get_distances().chi(_randoms_.T[2]) # Mpc/h
 
 	if sdss: samples = samples[:2]
 	for s, sample in enumerate(samples):
@@ -268,18 +455,18 @@ def make_jks(wdir, randoms=None, random_cutter=None, empty_patches=None, radians
 			print('no directory %s - skipping..'%pdir)
 			continue
 
-		copy_randoms = _randoms_.copy()
+		copy_randoms = _randoms_ # only ever filtered, never modified in place
 			
 		jkdir = join(pdir, 'JKsamples')
 		if not isdir(jkdir):
 			mkdir(jkdir)
 
 		# read patches
-		ldir = [i for i in listdir(pdir) if all([ps in i for ps in patch_str])]
+		ldir = [i for i in catalog_io.listdir(pdir) if all([ps in i for ps in patch_str])]
 		if len(ldir)==0:
 			print('invalid patch_str for locating patch.asc files - give str patterns punctuated by *s')
 			sys.exit()
-		patches = np.array([np.loadtxt(join(pdir, li)) for li in ldir])
+		patches = np.array([catalog_io.read(join(pdir, li)) for li in ldir])
 		print('N unmasked patches: %s'%patches.shape[0])
 
 		# if SDSS, cut randoms by colour
@@ -289,9 +476,9 @@ def make_jks(wdir, randoms=None, random_cutter=None, empty_patches=None, radians
 				colour = np.array( [~redcut, redcut][int('Red' in sample)], dtype=bool )
 			else: # do not apply colour cut if using general density samples
 				colour = np.ones_like(redcut, dtype=bool)
-			random_cutter_ = np.array( [np.array(rc, dtype=bool) & colour for rc in random_cutter], dtype=bool )
+			cube_labels = np.where(colour, random_labels, -1)
 		else:
-			random_cutter_ = np.array(random_cutter, dtype=bool)
+			cube_labels = np.array(random_labels, dtype=int)
 
 		if paths=='all':
 			ep_cut = np.array(empty_patches[s])
@@ -304,31 +491,34 @@ def make_jks(wdir, randoms=None, random_cutter=None, empty_patches=None, radians
 			ep_cut = np.array(empty_patches[s+4])
 			print('N swot patches: %s'%np.sum(ep_cut))
 
-		# apply skinny-patch cut to random-cubes
-		random_cutter_ = random_cutter_[ep_cut]
+		# apply skinny-patch cut to random-cubes; renumber populated cubes as the patch files
+		relabel = -np.ones(len(ep_cut) + 1, dtype=int)
+		relabel[:-1][ep_cut] = np.arange(ep_cut.sum())
+		region_labels = relabel[cube_labels] # label -1 indexes the final -1
 
-		# apply filtered cube-cuts to randoms & patches (cubes)
-		combined_random_cutter = np.zeros(len(copy_randoms), dtype=bool)
-		for random_cube in random_cutter_:
-			combined_random_cutter |= np.array(random_cube, dtype=bool)
-		copy_randoms = copy_randoms[combined_random_cutter]
-		#print('combined_random_cutter: ', sum(combined_random_cutter), '/', len(combined_random_cutter))
+		# trim randoms to populated cubes
+		in_cubes = region_labels >= 0
+		copy_randoms, region_labels = copy_randoms[in_cubes], region_labels[in_cubes]
+		#print('randoms in cubes: ', sum(in_cubes), '/', len(in_cubes))
 		#patches = patches[pop_patch_cut]
 
-		# downsample randoms to patches
+		# downsample randoms to patches, carrying region labels as a final column
 		patches_z = np.concatenate(patches, axis=0).T[2]
 		print('downsampling patched randoms before JK sampling..')
-		ds_randoms = downsample(copy_randoms, patches_z, nbin=(1, 1)[sdss], target_nz=10)
+		ds_randoms = downsample(np.column_stack((copy_randoms, region_labels)), patches_z, nbin=(1, 1)[sdss], target_nz=10)
+		ds_randoms, ds_labels = ds_randoms[:, :-1], np.array(ds_randoms[:, -1], dtype=int)
 		#print('ds_randoms.shape: ', ds_randoms.shape)
 
-		names = ascii.read(join(pdir, ldir[0])).keys()
+		names = catalog_io.names(join(pdir, ldir[0]))
 		names[:2] = [['# ra[deg]', 'dec[deg]'], ['# ra[rad]', 'dec[rad]']] [radians]
 		rand_names = names # redundant??
 
 		gc.collect()
+		if save_labels:
+			save_jk_labels(jkdir, patches, ldir, ds_randoms, units, rand_names, binary=binary, rand_labels=ds_labels)
 		if save_jks | jk_randoms:
 			num_cores = multiprocessing.cpu_count()
-			Parallel(n_jobs=num_cores)(delayed(para_jk_save)(jkdir, patches, save_jks, jk_randoms, ds_randoms, units, names, rand_names, j) for j in range(len(patches)) )
+			Parallel(n_jobs=num_cores)(delayed(para_jk_save)(jkdir, patches, save_jks, jk_randoms, ds_randoms, units, names, rand_names, j, binary=binary, rand_labels=ds_labels, region=patch_number(ldir[j])) for j in range(len(patches)) )
 		else:
 			print('no JK function called.')
 
@@ -384,10 +574,20 @@ if __name__ == '__main__':
 	help='perform downsampling (1), or just cut/save reals (0), default=1')
 	parser.add_argument(
 	'-readrand',
-	help='read in existing randoms for downsampling (1) -> must give -path arg, or lay down random points in a wedge defined by real coord limits (0), default=1',
+	help='read in existing randoms for downsampling (1) -> must give -path arg, or lay down area-uniform random points in the -mask footprint, with real redshifts (0), default=1',
 	type=int,
 	default=1)
 	parser.add_argument(
+	'-mask',
+	type=str,
+	default=None,
+	help='(for readrand=0) HEALPix footprint map for random points, default=map of pixels occupied by reals')
+	parser.add_argument(
+	'-nside',
+	type=int,
+	default=1024,
+	help='(for readrand=0, no -mask) HEALPix nside of footprint made from reals, default=1024')
+	parser.add_argument(
 	'-radians',
 	type=int,
 	default=0,
@@ -433,9 +633,12 @@ if __name__ == '__main__':
 			randoms = read_randoms(args.rand_path, args.random_cols)
 		else:
 			print('MAKING randoms..')
-			print('NOTE: should only make_randoms for box-like real footprint - no functionality for curved edges/masks YET(?!)')
-			randoms = make_randoms(reals)
-			#randoms = trim_randoms(randoms, reals, maxsep=0.1)
+			if args.mask is not None:
+				mask = args.mask
+			else:
+				print('no -mask: footprint = nside=%s pixels occupied by reals'%args.nside)
+				mask = footprint_mask(reals.T[0], reals.T[1], nside=args.nside)
+			randoms = footprint_randoms(mask, 25 * len(reals), z=reals.T[2])
 	
 	# cut redshift range
 	if args.zrange!=None:
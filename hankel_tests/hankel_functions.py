@@ -5,8 +5,7 @@ from scipy.interpolate import interp1d, interp2d
 from scipy.integrate import quad
 import hankel
 from hankel import get_h
-from astropy.cosmology import FlatLambdaCDM as FLCDM
-cosmo = FLCDM(Om0=0.25, H0=70, Ob0=0.044)
+from distances import get_distances
 
 def prep_kpar_integrand(kpar, kperp, Pi):
 	karg = np.sqrt(np.add.outer(kperp**2, kpar**2))
@@ -36,10 +35,6 @@ def upsample_k(kx, factor, spacing='log', n=None):
 	if spacing == 'lin':
 		return np.linspace(kx.min(), kx.max(), n)
 
-def fivept_stencil(func, x, h):
-	# returns f'(x), via 5pt stencil, for grid-spacing h
-	return (-func(x+2*h)+8*func(x+h)-8*func(x-h)+func(x-2*h))/(12*h)
-
 def zero_pad(k, pk, nzeros=10):
 	kl = 10**(np.log10(k[0]) - np.arange(1, nzeros+1) * np.log10(k[1]/k[0]))[::-1]
 	ku = 10**(np.log10(k[-1]) + np.arange(1, nzeros+1) * np.log10(k[-1]/k[-2]))
@@ -73,12 +68,11 @@ def compute_Wz(z, nz1, nz2):
 	assert pz1.shape == z.shape, "p(z) vs. z mismatch"
 	assert pz2.shape == z.shape, "p(z) vs. z mismatch"
 	# compute X(z) = comoving coordinate
-	chiz = lambda x: cosmo.comoving_distance(x) # h (hubble parameter) cancels
-	X = chiz(z).value
+	dist = get_distances() # h (hubble parameter) cancels
+	X = dist.chi(z)
 	Xsq = X**2
-	# compute X'(z) = first deriv.
-	h = z[1]-z[0]
-	Xpr = fivept_stencil(chiz, z, h).value
+	# compute X'(z) = first deriv., from the spline
+	Xpr = dist.dchi_dz(z)
 	# combine & integrate (Riemann sum) over z
 	W_nom = (pz1 * pz2) / (Xsq * Xpr)
 	W_nom = np.nan_to_num(W_nom)
@@ -2,48 +2,72 @@
 from __future__ import print_function, division
 from astropy.io import fits
 import numpy as np
-from astropy.cosmology import FlatLambdaCDM as FLCDM
-MICEcosmo = FLCDM(Om0=0.25, H0=70, Ob0=0.044)
-cmpc = MICEcosmo.comoving_distance
 import healpy as hp
 import gc
-
-def slice_jackknife(z, zmin=0.02, zmax=0.5, cube_cmpc_depth=150, dz=0.001):
-	z1 = z[(z >= zmin) & (z <= zmax)]
-	pdf = np.histogram(z1, bins=np.linspace(zmin, zmax, int((zmax - zmin)/dz)))
-	fp = pdf[0] / float(pdf[0].sum())
-	cdf = np.cumsum(fp)
-	zm = pdf[1][:-1]
-
-	nbin = 10
-	fracs = np.linspace(0., 1., nbin + 1)
-	ze = np.interp(fracs, cdf, zm)
-	min_depth = np.diff(cmpc(ze) * 0.7).min()
-	while np.float32(min_depth) <= cube_cmpc_depth:
-		nbin -= 1
-		fracs = np.linspace(0., 1., nbin + 1)
-		ze1 = np.interp(fracs, cdf, zm)
-		min_depth = np.diff(cmpc(ze1) * 0.7).min()
-		ze = ze1
-		#print('nbin = %i'%nbin)
-		#print(cmpc(ze) * 0.7)
-		#print(np.diff(cmpc(ze) * 0.7))
-		#print('\n')
+import os
+import glob
+import tempfile
+from catalog_io import file_hash
+from distances import get_distances
+
+def slice_jackknife(z, zmin=0.02, zmax=0.5, cube_cmpc_depth=150, weights=None, max_nbin=10):
+	# redshift edges of the largest number (<= max_nbin) of equal-count (or equal-weight) slabs whose
+	# comoving depths all exceed cube_cmpc_depth [Mpc/h] -- each candidate nbin is checked directly
+	# from the sorted CDF, with distances from a tabulated chi(z)
+	zcut = (z >= zmin) & (z <= zmax)
+	order = np.argsort(z[zcut])
+	zs = z[zcut][order]
+	w = np.ones_like(zs) if weights is None else np.asarray(weights, dtype=float)[zcut][order]
+	cdf = np.cumsum(w) / w.sum()
+
+	nbins = np.arange(1, max_nbin + 1)
+	min_depth = np.empty(len(nbins))
+	for i, nbin in enumerate(nbins):
+		ze = np.interp(np.linspace(0., 1., nbin + 1), cdf, zs)
+		min_depth[i] = np.diff(get_distances().chi(ze)).min()
+	deep = np.float32(min_depth) > cube_cmpc_depth
+	if not deep.any():
+		print('no slabs deeper than %s Mpc/h -- using 1'%cube_cmpc_depth)
+	nbin = nbins[deep].max() if deep.any() else 1
+
+	ze = np.interp(np.linspace(0., 1., nbin + 1), cdf, zs)
 	new_z_edge = np.concatenate(([zmin], ze[1:-1], [zmax]))
 	print('nbin = %i'%(len(new_z_edge) - 1))
 	print('z-edges:')
 	print(new_z_edge)
 	print('cMpc diffs:')
-	print(np.diff(cmpc(new_z_edge) * 0.7))
+	print(np.diff(get_distances().chi(new_z_edge)))
 	return new_z_edge
 
+def kmeans_centres(ra, dec, njk, nsample=200000, maxiter=100, tol=1e-5):
+	# njk k-means (kmeans_radec) centres on the sphere, trained on a random subsample of (ra, dec) [deg]
+	# points uniform over the footprint (randoms/pixels) give equal-area regions, galaxies equal-count
+	from kmeans_radec import kmeans_sample
+	X = np.column_stack((ra, dec))
+	km = kmeans_sample(X, njk, nsample=min(nsample, len(X)), maxiter=maxiter, tol=tol)
+	if not km.converged:
+		print('k-means jackknife centres not converged after %i iterations!'%maxiter)
+	return km.centers
+
+def assign_regions(ra, dec, centres, chunksize=2**20):
+	# nearest-centre region of each (ra, dec) [deg], in mini-batches so that memory is chunksize x njk
+	from kmeans_radec import KMeans
+	km = KMeans(centres)
+	labels = np.empty(len(ra), dtype=int)
+	for i in range(0, len(ra), chunksize):
+		labels[i:i+chunksize] = km.find_nearest(np.column_stack((ra[i:i+chunksize], dec[i:i+chunksize])))
+	return labels
+
 def betwixt((re1,re2,de1,de2,ze1,ze2)):
 	def make_cut(ra,dec,z):
 		return (ra>=re1)&(ra<=re2)&(dec>=de1)&(dec<=de2)&(z>=ze1)&(z<=ze2)
 	return make_cut
 
-def resample_data(fitsdata, sample_cuts, patchside=6, zcut=None, do_sdss=0, do_3d=1, cube_zdepth=150, largePi=0, mice=0, bitmaskCut=None, occ_thresh=0.67, mask_path='/share/splinter/hj/PhD/pixel_weights.fits', SHIFT=0, cols=None):
-	resampler = resampleTools(fitsdata, patchside, zcut, do_sdss, do_3d, sample_cuts, cube_zdepth=cube_zdepth, largePi=largePi, mice=mice, cols=cols)
+def resample_data(fitsdata, sample_cuts, patchside=6, zcut=None, do_sdss=0, do_3d=1, cube_zdepth=150, largePi=0, mice=0, bitmaskCut=None, occ_thresh=0.67, mask_path='/share/splinter/hj/PhD/pixel_weights.fits', SHIFT=0, cols=None, regions='grid', njk=50, centres_file=None, region_points=None):
+	# regions: 'grid' = patchside RA/Dec boxes, 'area'/'count' = njk k-means regions of equal area/galaxy count,
+	# trained on region_points (ra, dec) uniform over the footprint (else the footprint pixels) or on galaxies;
+	# centres are read from/saved to centres_file, so later runs reuse them. do_3d slices any regions into z-slabs
+	resampler = resampleTools(fitsdata, patchside, zcut, do_sdss, do_3d, sample_cuts, cube_zdepth=cube_zdepth, largePi=largePi, mice=mice, cols=cols, regions=regions, njk=njk, centres_file=centres_file)
 
 	# identify masked pixel coordinates
 	# lostpix_coords = resampler.find_lostpixels(bitmaskCut)
@@ -55,47 +79,36 @@ def resample_data(fitsdata, sample_cuts, patchside=6, zcut=None, do_sdss=0, do_3
 	else:
 		pixel_coords = None
 
-	# define patches & their degree of masking
-	patch_cuts, patch_weights, patch_idx, edges = resampler.define_edgecuts(pixel_coords=pixel_coords, SHIFT=SHIFT, cube_zdepth=cube_zdepth)
-
-	# apply patch cuts to data
-	patches = resampler.make_patches(fitsdata, patch_cuts)
+	# define patches (one integer patch label per galaxy, -1 = none) & their degree of masking
+	patch_labels, patch_weights, patch_idx, edges = resampler.define_edgecuts(pixel_coords=pixel_coords, SHIFT=SHIFT, cube_zdepth=cube_zdepth, region_points=region_points)
 
 	# filter patches straddling survey-edges
-	patch_cuts, patch_weights, error_scaling = resampler.filter_patches(patches, patch_cuts, patch_weights, patch_idx, edges,occupn_threshold=occ_thresh)
+	patch_labels, patch_weights, error_scaling = resampler.filter_patches(patch_labels, patch_weights, patch_idx, edges,occupn_threshold=occ_thresh)
 
-	# create function to trim randoms down to real JK footprint
-	random_cutter = resampler.find_patch_edges(patch_cuts)
+	# bounding boxes of patches, to trim randoms down to real JK footprint
+	resampler.find_patch_edges(patch_labels, len(patch_weights))
 
-	# apply sample cuts to patch-cuts
-	sample_patch_cuts = []
+	# apply sample cuts to patch labels
+	sample_patch_labels = []
 	for s_cut in resampler.sample_cuts:
-		spc = resampler.make_sample_patchcuts(patch_cuts, s_cut)
-		sample_patch_cuts.append(spc)
-	sample_patch_cuts = np.array(sample_patch_cuts)
-
-	# construct array of patches, per sample
-	patchData = []
-	for spc in sample_patch_cuts:
-		sample_patches = resampler.make_patches(fitsdata, spc)
-		patchData.append(sample_patches)
-
-	if do_3d:
-		# slice patches in z, creating jackknife cubes & random cube-cuts
-		cubeData = []
-		for i, spatches in enumerate(patchData):
-			if i==0:
-				cubes, cube_weights, random_cutter = resampler.make_cubes(spatches, patch_weights, edges[2], random_cutter=random_cutter)
-			else:
-				cubes, cube_weights = resampler.make_cubes(spatches, patch_weights, edges[2])
-			cubeData.append(cubes)
-	else:
-		patchData = np.array(patchData)
-		cubeData = patchData.copy()
-		cube_weights = patch_weights.copy()
-		del patchData, patch_weights
+		spl = resampler.make_sample_patchcuts(patch_labels, s_cut)
+		sample_patch_labels.append(spl)
+	sample_patch_labels = np.array(sample_patch_labels)
+
+	# construct array of patches/cubes, per sample -- slices of one region-sorted copy of each sample
+	cubeData = []
+	for spl in sample_patch_labels:
+		if do_3d:
+			# slice patches in z, creating jackknife cubes
+			cubes, cube_weights = resampler.make_cubes(fitsdata, spl, patch_weights, edges[2])
+		else:
+			cubes, cube_weights = resampler.make_patches(fitsdata, spl, len(patch_weights)), patch_weights.copy()
+		cubeData.append(cubes)
 
-	cubeData = np.array(cubeData)
+	cubeData_ = np.empty((len(cubeData), len(cube_weights)), dtype=object)
+	for i, cubes in enumerate(cubeData):
+		cubeData_[i] = cubes
+	cubeData = cubeData_
 #	empty_cut = np.ones(len(cubeData), dtype=bool)
 #	# rough cut against partially empty patches/cubes
 #	for i, cube
@@ -103,10 +116,12 @@ def resample_data(fitsdata, sample_cuts, patchside=6, zcut=None, do_sdss=0, do_3
 	print('\nN cubes: ', len(cubeData[0]),
 			'\nmin | max cube weights: %.4f | %.4f'%(cube_weights.min(), cube_weights.max()))
 
-	return cubeData, cube_weights, error_scaling, random_cutter
+	# random_labeller(ra, dec, z) gives the cube (patch, if not do_3d) number of randoms, -1 = none
+	random_labeller = resampler.label_randoms
+	return cubeData, cube_weights, error_scaling, random_labeller
 
 class resampleTools:
-	def __init__(self, fitsdata, patchside, zcut, do_sdss, do_3d, sample_cuts, cube_zdepth=150, largePi=0, mice=0, cols=None):
+	def __init__(self, fitsdata, patchside, zcut, do_sdss, do_3d, sample_cuts, cube_zdepth=150, largePi=0, mice=0, cols=None, regions='grid', njk=50, centres_file=None):
 		if cols is None:
 			self.cols = [ ['RA_GAMA', 'DEC_GAMA', 'Z_TONRY'], ['ra', 'dec', 'z'] ] [do_sdss]
 		else:
@@ -124,6 +139,10 @@ class resampleTools:
 		self.sample_cuts = sample_cuts
 		self.largePi = largePi
 		self.mice = mice
+		assert regions in ['grid', 'area', 'count'], "regions must be 'grid', 'area' or 'count'"
+		self.regions = regions
+		self.njk = njk
+		self.centres_file = centres_file
 
 	def find_lostpixels(self, *bitmask_):
 		# find coordinates of pixels lost to masking
@@ -174,16 +193,43 @@ class resampleTools:
 		return lostpix_coords
 
 	def read_pixel_weights(self, mask_path):
-		# make 2d-array of pixel coords and weights, for patch_weighting
+		# make 2d-array of (non-zero) footprint pixel coords and weights, for patch_weighting
+		# the table is built once per mask file, saved beside it as <mask>.footprint_nside<N>_<sha1>.npy,
+		# and memory-mapped on later runs
+		checksum = file_hash(mask_path)[:16]
+		tables = glob.glob('%s.footprint_nside*_%s.npy'%(mask_path, checksum))
+		if len(tables) != 0:
+			self.pixel_nside = int(tables[0].split('_nside')[-1].split('_')[0])
+			return np.load(tables[0], mmap_mode='r')
+
+		print('building footprint pixel table for %s..'%mask_path)
 		mask_map = hp.read_map(mask_path)
-		pix = np.arange(len(mask_map))
-		ra, dec = hp.pix2ang(2048, pix, lonlat=True)
+		self.pixel_nside = hp.npix2nside(len(mask_map))
+		pix = np.where(mask_map != 0)[0]
+		ra, dec = hp.pix2ang(self.pixel_nside, pix, lonlat=True)
 		z = np.ones_like(ra) * 0.2
 
-		pixel_coords = np.column_stack(( ra, dec, z, mask_map ))
+		pixel_coords = np.column_stack(( ra, dec, z, mask_map[pix] ))
+		table = '%s.footprint_nside%i_%s.npy'%(mask_path, self.pixel_nside, checksum)
+		try:
+			fd, tmp = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(os.path.abspath(mask_path)))
+			os.close(fd)
+			np.save(tmp, pixel_coords)
+			os.rename(tmp, table)
+		except (IOError, OSError):
+			print('cannot save footprint table beside mask -- rebuilding on every run')
 		return pixel_coords
 
-	def define_edgecuts(self, pixel_coords=None, SHIFT=0, cube_zdepth=150): # if gama, pixel_coords has 4 cols = (ra, dec, z(dummy), weight) and npix-rows
+	def count_patch_pixels(self, redg, dedg, patch_idx):
+		# number of nside=self.pixel_nside pixel centres per patch, over the whole sky (masked or not);
+		# only the dec-band of the patch grid is enumerated
+		theta1, theta2 = np.deg2rad(90. - dedg[-1]), np.deg2rad(90. - dedg[0])
+		pix = hp.query_strip(self.pixel_nside, max(theta1, 0.), min(theta2, np.pi), inclusive=False)
+		pra, pdec = hp.pix2ang(self.pixel_nside, pix, lonlat=True)
+		pix_labels = self.label_patches(pra, pdec, np.ones_like(pra) * 0.2, redg, dedg, patch_idx)
+		return np.bincount(pix_labels[pix_labels >= 0], minlength=len(patch_idx))
+
+	def define_edgecuts(self, pixel_coords=None, SHIFT=0, cube_zdepth=150, region_points=None): # if gama, pixel_coords has 4 cols = (ra, dec, z(dummy), weight) and npix-rows
 		# given desired patch/box-sizes, divide sky into patches
 		# return sets of patch-cuts for application to catalogs, with weights due to lost pixels
 
@@ -227,6 +273,9 @@ class resampleTools:
 			else:
 				zedg = np.array([z.min, z.max()])
 
+		if self.regions != 'grid':
+			return self.define_kmeans_regions(ra, dec, z, zedg, pixel_coords=pixel_coords, region_points=region_points)
+
 		redg,dedg,zedg = map(lambda x: np.array(x), [redg,dedg,zedg])
 		radiff, decdiff = (np.diff(i) for i in [redg,dedg])
 		print('ra | dec: %.2f | %.2f'%(radiff.min(),decdiff.min()))
@@ -237,56 +286,145 @@ class resampleTools:
 		hist2d_c, hist2d_e = np.histogramdd(gal_coords[:,:2], bins=[redg,dedg])
 		patch_idx = np.array(np.where(hist2d_c!=0)).T
 
-		patch_cuts = np.empty( [patch_idx.shape[0], len(gal_coords)] )
+		# label galaxies by populated patch, numbered as patch_idx
+		patch_labels = self.label_patches(ra, dec, z, redg, dedg, patch_idx)
 		if gama:
-			patch_pixel_weights = np.zeros( [patch_idx.shape[0], len(pixel_coords)] )
-			patch_pixel_count = np.empty( patch_idx.shape[0] )
-		for c, (i,j) in enumerate(patch_idx):
-			edges = redg[i], redg[i+1], dedg[j], dedg[j+1], 0., 2.
-			cut = betwixt(edges) # returns function cut(), which takes ra,dec,z and returns boolean array
-			patch_cuts[c] = cut(ra,dec,z)
-			if gama:
-				patch_pixel_weights[c] += np.where( cut(*pixel_coords.T[:3]), pixel_coords.T[3], 0 )
-				patch_pixel_count[c] = np.sum( cut(*pixel_coords.T[:3]) )
-
-		if gama:
-			patch_weights = np.zeros( len(patch_pixel_weights) )
-			for i in range(len(patch_weights)):
-				patch_weights[i] = np.sum(patch_pixel_weights[i]) / np.float32( patch_pixel_count[i] )
+			# mean pixel weight per patch, in one pass over the (non-zero) pixels within the patch grid,
+			# normalised by the count of all pixels in each patch
+			pra, pdec, pz, pw = pixel_coords.T[:4]
+			in_grid = (pra >= redg[0]) & (pra <= redg[-1]) & (pdec >= dedg[0]) & (pdec <= dedg[-1])
+			pix_labels = self.label_patches(pra[in_grid], pdec[in_grid], pz[in_grid], redg, dedg, patch_idx)
+			in_patch = pix_labels >= 0
+			patch_pixel_weights = np.bincount(pix_labels[in_patch], weights=pw[in_grid][in_patch], minlength=len(patch_idx))
+			patch_pixel_count = self.count_patch_pixels(redg, dedg, patch_idx)
+			patch_weights = patch_pixel_weights / np.float32( patch_pixel_count )
 		else:
 			patch_weights = np.ones( patch_idx.shape[0] )
 		print('===============\t CHECK THIS \t================\npatch weights:\n',patch_weights)
 
 		edges = (redg,dedg,zedg)
-		return patch_cuts, patch_weights, patch_idx, edges
-
-	def make_patches(self, fits_cat, patch_cuts):
-		# apply patch cuts to fitsdata
-		patches = np.array([fits_cat[np.array(i,dtype=bool)] for i in patch_cuts]) # array of populated patches, where each is a fits-table
-		return patches
-
-	def filter_patches(self, patches, patch_cuts, patch_weights, patch_idx, edges, occupn_threshold=0.5):
+		self.edges, self.patch_idx = edges, patch_idx
+		return patch_labels, patch_weights, patch_idx, edges
+
+	def define_kmeans_regions(self, ra, dec, z, zedg, pixel_coords=None, region_points=None):
+		# k-means regions; centres from self.centres_file if it holds njk of them, else trained (& saved there)
+		centres = None
+		if (self.centres_file is not None) and os.path.exists(self.centres_file):
+			centres = np.atleast_2d(np.loadtxt(self.centres_file))
+			print('read %i k-means jackknife centres from %s'%(len(centres), self.centres_file))
+			if len(centres) != self.njk:
+				print('..not njk = %i -- retraining'%self.njk)
+				centres = None
+		if centres is None:
+			if self.regions == 'count':
+				print('training %i equal-count k-means regions on galaxies..'%self.njk)
+				centres = kmeans_centres(ra, dec, self.njk)
+			elif region_points is not None:
+				print('training %i equal-area k-means regions on footprint points..'%self.njk)
+				centres = kmeans_centres(region_points[0], region_points[1], self.njk)
+			elif pixel_coords is not None:
+				print('training %i equal-area k-means regions on footprint pixels..'%self.njk)
+				centres = kmeans_centres(pixel_coords[:, 0], pixel_coords[:, 1], self.njk)
+			else:
+				raise ValueError("equal-area regions need region_points or footprint pixels")
+			if self.centres_file is not None:
+				np.savetxt(self.centres_file, centres, header='ra[deg]\tdec[deg] -- %s k-means jackknife centres'%self.regions)
+
+		# keep populated regions, numbered as patch_idx
+		region_labels = assign_regions(ra, dec, centres)
+		patch_idx = np.where(np.bincount(region_labels, minlength=len(centres)) != 0)[0]
+		self.centres = centres[patch_idx]
+		patch_labels = self.label_regions(ra, dec, z)
+		if pixel_coords is not None:
+			# mean weight of the footprint pixels in each region, within the galaxies' bounding box
+			pra, pdec, pw = pixel_coords[:, 0], pixel_coords[:, 1], pixel_coords[:, 3]
+			pix_labels = assign_regions(pra, pdec, self.centres)
+			b = self.find_patch_edges(patch_labels, len(patch_idx))[pix_labels]
+			in_box = (pra >= b[:,0]) & (pra <= b[:,1]) & (pdec >= b[:,2]) & (pdec <= b[:,3])
+			patch_weights = np.bincount(pix_labels[in_box], weights=pw[in_box], minlength=len(patch_idx)) / np.float32( np.bincount(pix_labels[in_box], minlength=len(patch_idx)) )
+		else:
+			patch_weights = np.ones(len(patch_idx))
+		print('k-means regions: %i populated / %i, min | max galaxies per region: %i | %i'%(len(patch_idx), len(centres), np.bincount(patch_labels).min(), np.bincount(patch_labels).max()))
+
+		edges = (None, None, np.array(zedg))
+		self.edges, self.patch_idx = edges, patch_idx
+		return patch_labels, patch_weights, patch_idx, edges
+
+	def label_regions(self, ra, dec, z):
+		# patch/region number (row of self.patch_idx) of each object, -1 = none
+		if self.regions == 'grid':
+			return self.label_patches(ra, dec, z, self.edges[0], self.edges[1], self.patch_idx)
+		labels = assign_regions(ra, dec, self.centres)
+		labels[(z < 0.) | (z > 2.)] = -1
+		return labels
+
+	def label_patches(self, ra, dec, z, redg, dedg, patch_idx, zlims=(0., 2.)):
+		# patch number (row of patch_idx) of each object by digitizing ra/dec, -1 = outside patches
+		# the upper edges are closed, as in np.histogramdd
+		i = np.digitize(ra, redg) - 1
+		j = np.digitize(dec, dedg) - 1
+		i[ra == redg[-1]] = len(redg) - 2
+		j[dec == dedg[-1]] = len(dedg) - 2
+		inside = (i >= 0) & (i < len(redg) - 1) & (j >= 0) & (j < len(dedg) - 1) & (z >= zlims[0]) & (z <= zlims[1])
+		lookup = -np.ones([len(redg) - 1, len(dedg) - 1], dtype=int)
+		lookup[patch_idx[:, 0], patch_idx[:, 1]] = np.arange(len(patch_idx))
+		labels = -np.ones(len(ra), dtype=int)
+		labels[inside] = lookup[i[inside], j[inside]]
+		return labels
+
+	def group_labels(self, labels, nlabel):
+		# indices of objects per label 0..nlabel-1 (original order within each), from one stable sort
+		order = np.argsort(labels, kind='mergesort')
+		bounds = np.searchsorted(labels[order], np.arange(nlabel + 1))
+		return [order[bounds[k]:bounds[k+1]] for k in range(nlabel)]
+
+	def split_by_label(self, fits_cat, labels, nlabel):
+		# object array of per-label catalogues 0..nlabel-1 -- contiguous slices (views) of one
+		# label-sorted copy of the labelled objects, original order kept within each
+		order = np.argsort(labels, kind='mergesort')
+		bounds = np.searchsorted(labels[order], np.arange(nlabel + 1))
+		sorted_cat = fits_cat[order[bounds[0]:bounds[-1]]]
+		bounds -= bounds[0]
+		parts = np.empty(nlabel, dtype=object)
+		for k in range(nlabel):
+			parts[k] = sorted_cat[bounds[k]:bounds[k+1]]
+		return parts
+
+	def make_patches(self, fits_cat, patch_labels, npatch):
+		# split fitsdata by patch label
+		return self.split_by_label(fits_cat, patch_labels, npatch) # array of populated patches, where each is a fits-table
+
+	def patch_occupancy(self, patch_labels, patch_idx, edges, nfine=10):
+		# occupancy map: (npatch, nfine, nfine) boolean, True where a fine ra/dec sub-cell of a patch holds
+		# galaxies -- from one bincount over (patch, sub-cell) indices; kept as self.occupancy
+		ra, dec = self.data[self.cols[0]], self.data[self.cols[1]]
+		inpatch = patch_labels >= 0
+		l = patch_labels[inpatch]
+		r, d = patch_idx[l, 0], patch_idx[l, 1]
+		redg, dedg = edges[0], edges[1]
+		# sub-cell of each galaxy within its patch; upper edges closed, as in np.histogramdd
+		u = np.clip(np.floor((ra[inpatch] - redg[r]) / (redg[r+1] - redg[r]) * nfine).astype(int), 0, nfine - 1)
+		v = np.clip(np.floor((dec[inpatch] - dedg[d]) / (dedg[d+1] - dedg[d]) * nfine).astype(int), 0, nfine - 1)
+		counts = np.bincount((l * nfine + u) * nfine + v, minlength=len(patch_idx) * nfine**2)
+		self.occupancy = counts.reshape(len(patch_idx), nfine, nfine) != 0
+		return self.occupancy
+
+	def filter_patches(self, patch_labels, patch_weights, patch_idx, edges, occupn_threshold=0.5):
+		if self.regions != 'grid':
+			print('k-means regions follow the footprint: no discarded patches')
+			self.patch_idx = patch_idx
+			return patch_labels, patch_weights, 1.
 		print('filtering survey-edges..')
-		pwei = np.empty(len(patches))
-		parea = np.empty(len(patches))
-		survey_area = 0
-		jackknife_area = 0
 		Area = lambda a1,a2,d1,d2: (a2-a1)*(np.sin(d2)-np.sin(d1))
 
-		for i, patch in enumerate(patches):
-			# subdivide each patch for occupations
-			coords = np.column_stack((patch[self.cols[0]], patch[self.cols[1]], patch[self.cols[2]]))
-			r,d = patch_idx[i] # indices patch-edges
-			patch_edges = (edges[0][r], edges[0][r+1], edges[1][d], edges[1][d+1])
-			patch_edges_rad = [np.deg2rad(pe) for pe in patch_edges]
-			fine_bins = (np.linspace(patch_edges[0], patch_edges[1], 11), np.linspace(patch_edges[2], patch_edges[3], 11))
-			fine_hist2d = np.histogramdd(coords[:,:2], bins=fine_bins)
-
-			pwei[i] = np.sum(fine_hist2d[0]!=0) / 100.
-			parea[i] = Area(*patch_edges_rad) * (180./np.pi)**2
-			survey_area += pwei[i] * parea[i]
-			if pwei[i] >= occupn_threshold:
-				jackknife_area += pwei[i] * parea[i]
+		# fraction of occupied sub-cells & area [deg^2] of each patch
+		occupancy = self.patch_occupancy(patch_labels, patch_idx, edges)
+		pwei = occupancy.reshape(len(patch_idx), -1).mean(axis=1)
+		r, d = patch_idx[:, 0], patch_idx[:, 1]
+		patch_edges_rad = [np.deg2rad(pe) for pe in (edges[0][r], edges[0][r+1], edges[1][d], edges[1][d+1])]
+		parea = Area(*patch_edges_rad) * (180./np.pi)**2
+		survey_area = np.sum(pwei * parea)
+		jackknife_area = np.sum((pwei * parea)[pwei >= occupn_threshold])
 
 		if self.do_sdss:
 			patch_filter = pwei >= occupn_threshold
@@ -298,7 +436,7 @@ class resampleTools:
 			'\ntotal (populated) patches: ', len(patch_filter),
 			'\ndiscarded edge-patches (SDSS): ', sum(~patch_filter),
 			'\nremaining: ', sum(patch_filter),
-			'\nmin | max | mean | (step) in patch occupations: %.4f | %.4f | %.4f | (%.4f)'%(highfracs.min(), highfracs.max(), np.mean(highfracs), 1/100.),
+			'\nmin | max | mean | (step) in patch occupations: %.4f | %.4f | %.4f | (%.4f)'%(highfracs.min(), highfracs.max(), np.mean(highfracs), 1./occupancy[0].size),
 			)
 
 		area_scaling = jackknife_area/survey_area
@@ -310,61 +448,55 @@ class resampleTools:
 			print('retained vs. occupied area fraction: %.3f'%area_scaling)
 			print('SCALE JACKKNIFE ERRORS DOWN BY ~%.3f TO ACCOUNT FOR LOST (EDGE) PATCHES...!!'%scale_factor)
 
-		patch_cuts = patch_cuts[patch_filter]
+		# renumber retained patches, discarded -> -1
+		relabel = -np.ones(len(patch_filter) + 1, dtype=int)
+		relabel[:-1][patch_filter] = np.arange(patch_filter.sum())
+		patch_labels = relabel[patch_labels] # label -1 indexes the final -1
 		patch_weights = patch_weights[patch_filter]
+		self.patch_idx = patch_idx[patch_filter]
 		if self.do_sdss:
 			patch_weights = pwei[patch_filter] * parea[patch_filter] / (self.ra_side * self.dec_side)
 			print('SDSS patch weights from area * occupation:\n', patch_weights)
-		return np.array(patch_cuts, dtype=bool), patch_weights, scale_factor
+		return patch_labels, patch_weights, scale_factor
 
-	def make_sample_patchcuts(self, patch_cuts, sample_cut):
-		# apply sample cuts ONE AT A TIME to patch cuts
-		new_patch_cuts = np.empty_like(patch_cuts)
-		for i in range(len(patch_cuts)):
-			new_patch_cuts[i] = patch_cuts[i] & sample_cut
-		return new_patch_cuts
-
-	def make_cubes(self, patches, patch_weights, zedges, random_cutter=None):
-		# slice patches in redshift, creating jackknife cubes
-		print('slicing patches into cubes..')
-		cubes = []
-		cube_weights = []
-		new_random_cutter = []
-		#if self.do_sdss:
-		#	zedges = zedges[zedges <= 0.25]
-		for i, patch in enumerate(patches):
-			patch_z = patch[self.cols[2]]
-			zcuts = [ (patch_z>=zedges[j]) & (patch_z<=zedges[j+1]) for j in range(len(zedges)-1) ]
-			for k, zcut in enumerate(zcuts):
-                                cubes.append( patch[zcut] )
-                                cube_weights.append( patch_weights[i] )
-				if type(random_cutter)!=type(None):
-					# make cut() function for random cubing - need to discard cubes
-					cube_cut = betwixt((-np.inf, np.inf, -np.inf, np.inf, zedges[k], zedges[k+1]))
-					new_random_cutter.append( (random_cutter[i], cube_cut) )
-
-		cubes = np.array(cubes)
-		cube_weights = np.array(cube_weights)
-		cubes = cubes.flatten()
-		cube_weights = cube_weights.flatten()
-
-		new_random_cutter = np.array(new_random_cutter)
-
-		if type(random_cutter)!=type(None):
-			return cubes, cube_weights, new_random_cutter
-		else:
-			return cubes, cube_weights
-
-	def find_patch_edges(self, patch_cuts):
-		random_cutter = []
-		for i, patch_cut in enumerate(patch_cuts):
-			ra, dec, z = self.data[self.cols[0]], self.data[self.cols[1]], self.data[self.cols[2]]
-			ra, dec, z = ra[patch_cut], dec[patch_cut], z[patch_cut]
-			p_cut = betwixt((ra.min(), ra.max(), dec.min(), dec.max(), z.min(), z.max()))
-			random_cutter.append(p_cut)
-
-		random_cutter = np.array(random_cutter)
-
-		return random_cutter
+	def make_sample_patchcuts(self, patch_labels, sample_cut):
+		# apply sample cut to patch labels; objects outside the sample -> -1
+		return np.where(np.array(sample_cut, dtype=bool), patch_labels, -1)
 
+	def cube_labels(self, patch_labels, z, zedges):
+		# combined (patch, z-slice) label patch*nz + k of each object, -1 = none; the top z-edge is closed
+		nz = len(zedges) - 1
+		k = np.digitize(z, zedges) - 1
+		k[z == zedges[-1]] = nz - 1
+		return np.where((patch_labels >= 0) & (k >= 0) & (k < nz), patch_labels * nz + k, -1)
 
+	def make_cubes(self, fits_cat, patch_labels, patch_weights, zedges):
+		# slice patches in redshift, creating jackknife cubes numbered patch*nz + k
+		print('slicing patches into cubes..')
+		nz = len(zedges) - 1
+		labels = self.cube_labels(patch_labels, fits_cat[self.cols[2]], zedges)
+		cubes = self.split_by_label(fits_cat, labels, len(patch_weights) * nz)
+		cube_weights = np.repeat(patch_weights, nz)
+		return cubes, cube_weights
+
+	def find_patch_edges(self, patch_labels, npatch):
+		# (ra, dec, z) bounding box of the galaxies in each patch
+		ra, dec, z = self.data[self.cols[0]], self.data[self.cols[1]], self.data[self.cols[2]]
+		self.patch_bounds = np.array([(ra[idx].min(), ra[idx].max(), dec[idx].min(), dec[idx].max(), z[idx].min(), z[idx].max())
+										for idx in self.group_labels(patch_labels, npatch)])
+		return self.patch_bounds
+
+	def label_randoms(self, ra, dec, z):
+		# cube (or patch, if not do_3d) number of each random, -1 = outside the jackknife footprint;
+		# one labelling pass (patch grid digitize / nearest k-means centre), trimmed to each patch's galaxy bounding box,
+		# then z-slabs -- cube numbers as in make_cubes
+		zedg = self.edges[2]
+		labels = self.label_regions(ra, dec, z)
+		inside = labels >= 0
+		b = self.patch_bounds[labels[inside]]
+		ra_in, dec_in, z_in = ra[inside], dec[inside], z[inside]
+		inside[inside] = (ra_in >= b[:,0]) & (ra_in <= b[:,1]) & (dec_in >= b[:,2]) & (dec_in <= b[:,3]) & (z_in >= b[:,4]) & (z_in <= b[:,5])
+		labels[~inside] = -1
+		if self.do_3d:
+			labels = self.cube_labels(labels, z, zedg)
+		return labels
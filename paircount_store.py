@@ -0,0 +1,110 @@
+from __future__ import print_function, division
+import os
+import json
+import time
+import hashlib
+import tempfile
+import numpy as np
+from catalog_cache import array_hash
+import catalog_io
+from catalog_io import file_hash
+
+# TreeCorr config entries which change the binning of pair counts
+BINNING_KEYS = ['metric', 'bin_slop', 'min_sep', 'max_sep', 'nbins', 'sep_units']
+
+def rr_meta(randf, rands, config, Pi, random_oversampling, random_seed=None, method='treecorr', labels=None):
+	# everything the RR counts depend on -- random catalogue contents & thinning, (r_p, Pi) binning,
+	# counting method; not file paths, so identical randoms match wherever they are kept
+	meta = {'random_hashes': [file_hash(catalog_io.source(f)) for f in randf],
+			'weight_hashes': [array_hash(np.asarray(r.w, dtype=float)) for r in rands],
+			'random_oversampling': float(random_oversampling),
+			'random_seed': random_seed,
+			'binning': dict((k, str(config[k])) for k in BINNING_KEYS if k in config),
+			'Pi': [float(p) for p in Pi],
+			'method': method}
+	if labels is not None:
+		meta['label_hashes'] = [array_hash(l) for l in labels]
+	return meta
+
+def _dump_json(obj, fname):
+	with open(fname, 'w') as f:
+		json.dump(obj, f, indent=1, sort_keys=True)
+
+class PairCountStore:
+	"""
+	Indexed store of normalisation (RR/RD) pair counts. Each set of counts is an
+	<key>.npz in store_dir, keyed by the sha1 of its metadata (random catalogue
+	hashes, thinning weights/seed, binning), beside a <key>.json of that metadata --
+	one file per entry, so concurrent writers never lose each other's entries.
+	manifest() indexes every entry, so stored counts can be inspected & matched between runs.
+	Entries are evicted least-recently-used once the directory exceeds max_bytes.
+	"""
+	def __init__(self, store_dir, max_bytes=2e9):
+		self.store_dir = store_dir
+		self.max_bytes = max_bytes
+		if not os.path.isdir(store_dir):
+			try:
+				os.makedirs(store_dir)
+			except OSError: # made by another process
+				pass
+
+	def key(self, meta):
+		return hashlib.sha1(json.dumps(meta, sort_keys=True).encode()).hexdigest()
+
+	def entry(self, key):
+		return os.path.join(self.store_dir, key + '.npz')
+
+	def get(self, key):
+		try:
+			with np.load(self.entry(key)) as f:
+				counts = dict((k, f[k]) for k in f.files)
+			os.utime(self.entry(key), None) # mark as recently used
+			return counts
+		except (IOError, OSError, ValueError):
+			return None
+
+	def put(self, key, counts, meta, **info):
+		# info: extra metadata for inspection only (e.g. random file paths), not part of the key
+		self._write(self.entry(key), lambda tmp: np.savez(tmp, **counts), suffix='.npz')
+		entry_meta = dict(meta, created=time.strftime('%Y-%m-%d %H:%M:%S'), **info)
+		self._write(self.entry(key)[:-4] + '.json', lambda tmp: _dump_json(entry_meta, tmp), suffix='.json')
+		self.evict()
+
+	def evict(self):
+		entries = []
+		for f in os.listdir(self.store_dir):
+			if f.endswith('.npz') and not f.startswith('tmp'):
+				try:
+					st = os.stat(os.path.join(self.store_dir, f))
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, f))
+		entries.sort()
+		total = sum(e[1] for e in entries)
+		for mtime, size, f in entries[:-1]:
+			if total <= self.max_bytes:
+				break
+			for fname in [f, f[:-4] + '.json']:
+				try:
+					os.remove(os.path.join(self.store_dir, fname))
+				except OSError:
+					pass
+			total -= size
+
+	def manifest(self):
+		manifest = {}
+		for f in os.listdir(self.store_dir):
+			if f.endswith('.json') and not f.startswith('tmp'):
+				try:
+					manifest[f[:-5]] = json.load(open(os.path.join(self.store_dir, f)))
+				except (IOError, OSError, ValueError):
+					pass
+		return manifest
+
+	def _write(self, fname, writer, suffix):
+		# write-then-rename, so concurrent processes never read partial entries
+		fd, tmp = tempfile.mkstemp(prefix='tmp', suffix=suffix, dir=self.store_dir)
+		os.close(fd)
+		writer(tmp)
+		os.rename(tmp, fname)
+
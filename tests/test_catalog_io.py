@@ -0,0 +1,48 @@
+from __future__ import print_function, division
+import os
+import time
+import numpy as np
+import catalog_io
+
+NAMES = ['# ra[rad]', 'dec[rad]', 'chi[Mpc/h]']
+
+def _cat(n=20):
+	return np.random.RandomState(0).rand(n, len(NAMES))
+
+def test_ascii_by_default(tmpdir):
+	path = str(tmpdir.join('cat.asc'))
+	catalog_io.write(path, _cat(), names=NAMES)
+	assert os.path.exists(path)
+	assert not os.path.exists(catalog_io.binary_path(path))
+	assert catalog_io.count(path) == 20
+
+def test_binary_replaces_ascii(tmpdir):
+	path = str(tmpdir.join('cat.asc'))
+	catalog_io.write(path, _cat(), names=NAMES)
+	catalog_io.write(path, _cat(5), names=NAMES, binary=1)
+	assert not os.path.exists(path)
+	assert catalog_io.has_binary(path)
+	assert catalog_io.names(path) == NAMES
+	np.testing.assert_array_equal(catalog_io.read(path), _cat(5))
+	assert catalog_io.listdir(str(tmpdir)) == ['cat.asc']
+
+def test_export_keeps_binary_fresh(tmpdir):
+	path = str(tmpdir.join('cat.asc'))
+	cat = _cat()
+	catalog_io.write(path, cat, names=NAMES, binary=1)
+	catalog_io.export_ascii(path)
+	assert catalog_io.has_binary(path)
+	mtime = os.path.getmtime(path)
+	time.sleep(0.01)
+	catalog_io.export_ascii(path) # no-op
+	assert os.path.getmtime(path) == mtime
+	np.testing.assert_allclose(np.loadtxt(path), cat)
+
+def test_edited_ascii_supersedes_binary(tmpdir):
+	path = str(tmpdir.join('cat.asc'))
+	catalog_io.write(path, _cat(), names=NAMES, binary=1)
+	catalog_io.export_ascii(path)
+	with open(path, 'a') as f:
+		f.write('0.1\t0.2\t0.3\n')
+	assert not catalog_io.has_binary(path)
+	assert catalog_io.count(path) == 21
@@ -0,0 +1,29 @@
+from __future__ import print_function, division
+import numpy as np
+import pytest
+pytest.importorskip('healpy')
+pytest.importorskip('joblib')
+from astropy.table import Table
+import downsampler
+
+def _fits_randoms(tmpdir, n=50):
+	rng = np.random.RandomState(0)
+	t = Table([rng.rand(n) * 10., rng.rand(n) * 10., 0.1 + rng.rand(n) * 0.4], names=('RA', 'DEC', 'Z'))
+	path = str(tmpdir.join('randoms.fits'))
+	t.write(path)
+	return path, t
+
+def test_stream_fits_missing_extra_column(tmpdir):
+	path, t = _fits_randoms(tmpdir)
+	chunks = list(downsampler.iter_randoms(path, extra_cols=('color',), chunksize=20))
+	assert [len(c) for c in chunks] == [20, 20, 10]
+	out = np.concatenate(chunks)
+	np.testing.assert_allclose(out[:, :3], np.column_stack((t['RA'], t['DEC'], t['Z'])))
+	np.testing.assert_array_equal(out[:, 3:], 1.)
+
+def test_stream_fits_zlims(tmpdir):
+	path, t = _fits_randoms(tmpdir)
+	out = downsampler.stream_randoms(path, extra_cols=('color',), zlims=(0.2, 0.4), chunksize=20)
+	n = np.sum((t['Z'] >= 0.2) & (t['Z'] <= 0.4))
+	assert out.shape == (n, 5)
+	np.testing.assert_array_equal(out[:, 4], 1.)
@@ -0,0 +1,48 @@
+from __future__ import print_function, division
+import numpy as np
+import pytest
+treecorr = pytest.importorskip('treecorr')
+import catalog_io
+import treecorr_3DCF
+
+CONFIG = {'file_type': 'ASCII', 'ra_col': 1, 'dec_col': 2, 'r_col': 3, 'g1_col': 4, 'g2_col': 5,
+		'ra_units': 'radians', 'dec_units': 'radians', 'metric': 'Rperp', 'bin_slop': 0.,
+		'min_sep': 0.5, 'max_sep': 10., 'nbins': 5, 'min_rpar': -20., 'max_rpar': 20.}
+NAMES = ['# ra[rad]', 'dec[rad]', 'chi[Mpc/h]', 'e1', 'e2', 'e_weight']
+
+def _catalogue(tmpdir, name, n, seed):
+	rng = np.random.RandomState(seed)
+	cat = np.column_stack((rng.rand(n) * 0.05, rng.rand(n) * 0.05, 500. + rng.rand(n) * 100.,
+							rng.normal(0, 0.3, n), rng.normal(0, 0.3, n), np.ones(n)))
+	path = str(tmpdir.join(name))
+	catalog_io.write(path, cat, names=NAMES)
+	return path
+
+@pytest.fixture
+def files(tmpdir):
+	return (_catalogue(tmpdir, 'dens.asc', 300, 1), _catalogue(tmpdir, 'shapes.asc', 300, 2),
+			_catalogue(tmpdir, 'rand1.asc', 1500, 3), _catalogue(tmpdir, 'rand2.asc', 1500, 4))
+
+@pytest.mark.parametrize('metric', ['Rperp', 'OldRperp'])
+def test_ng_single_pass_matches_treecorr(files, metric):
+	# pins r_par/r_p definitions & the sign convention of the tangential/cross projection
+	dens, shapes, rand1, rand2 = files
+	kw = dict(estimator='PW1', nbins_rpar=4, random_oversampling=10., verbosity=0)
+	conf = dict(CONFIG, metric=metric)
+	r0, gt0, gx0 = treecorr_3DCF.compute_w([dens, shapes], [rand1, rand2], conf.copy(), single_pass=0, **kw)[:3]
+	r1, gt1, gx1 = treecorr_3DCF.compute_w([dens, shapes], [rand1, rand2], conf.copy(), single_pass=1, **kw)[:3]
+	np.testing.assert_allclose(r1, r0, rtol=1e-6)
+	np.testing.assert_allclose(gt1, gt0, rtol=1e-6, atol=1e-12)
+	np.testing.assert_allclose(gx1, gx0, rtol=1e-6, atol=1e-12)
+
+def test_wgg_single_pass_matches_treecorr(files):
+	dens, shapes, rand1, rand2 = files
+	kw = dict(estimator='wgg', nbins_rpar=4, random_oversampling=10., verbosity=0)
+	r0, w0 = treecorr_3DCF.compute_w([dens, shapes], [rand1, rand2], CONFIG.copy(), single_pass=0, **kw)[:2]
+	r1, w1 = treecorr_3DCF.compute_w([dens, shapes], [rand1, rand2], CONFIG.copy(), single_pass=1, **kw)[:2]
+	np.testing.assert_allclose(w1, w0, rtol=1e-6, atol=1e-12)
+
+def test_single_pass_rejects_other_metrics(files):
+	dens, shapes, rand1, rand2 = files
+	with pytest.raises(ValueError):
+		treecorr_3DCF.compute_w([dens, shapes], [rand1, rand2], dict(CONFIG, metric='Euclidean'), single_pass=1, verbosity=0)
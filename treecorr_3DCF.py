@@ -1,19 +1,48 @@
 from __future__ import division
+import os
+import warnings
 import numpy as np
 from scipy.integrate import simps
 #from progress.bar import ChargingBar as Bar
 from tqdm import tqdm
 import treecorr
-import pickle
+import catalog_cache
+import catalog_io
+import paircount_store
 midpoints = lambda x: (x[1:] + x[:-1]) / 2.
 
-def compute_w(dataf, randf, config, estimator='PW1', compensated=1, nbins_rpar=30, random_oversampling=10., verbosity=1, largePi=0, **kwargs):
+def compute_w(dataf, randf, config, estimator='PW1', compensated=1, nbins_rpar=30, random_oversampling=10., verbosity=1, largePi=0, single_pass=0, return_3d=0, cache_dir=None, cache_max_gb=20., jk_labels=None, random_seed=None, thinning='random', rr_store=None, catalogs=None, masks=None, random_draws=None, max_pairs=2e7, rr_store_max_gb=2., **kwargs):
 	"""
 	dataf: paths to galaxy samples
 	randf: paths to random points corresponding to galaxy samples
 	config: path to config file, or dict specifying file types; column names/numbers, etc. a la TreeCorr configuration
 	estimator: 'PW1', 'PW2', 'AS' or 'wgg' to specify correlation & estimator
 	nbins_rpar: number of line-of-sight bins for 3D correlation function -- specify limits in config arg
+	single_pass: 1 = count all (r_p, Pi) bins in one traversal of the catalogues (count_pairs_3d),
+		0 = one TreeCorr run per Pi-slice
+	max_pairs: single_pass only -- bound on the number of pairs held in memory at once by count_pairs_3d
+	return_3d: 1 = also return the (Pi-edges, 2D signal/npair grids) before Pi-integration
+	cache_dir: directory for the content-addressed catalogue cache (catalog_cache), shared between
+		calls & processes -- default None = parse catalogues on every call
+	catalogs: catalog_cache.CatalogCache to draw catalogues from, in place of cache_dir (see compute_w_batch)
+	masks: 4x boolean arrays (or None = keep all) selecting the objects of dataf[0], dataf[1], randf[0],
+		randf[1] to correlate -- e.g. a delete-one jackknife sample of region-labelled catalogues, with
+		no sample files written; the unmasked catalogues are read once when drawn from catalogs/cache_dir
+	random_draws: with catalogs, (u1, u2) uniform draws per object of randf[0/1] to thin by (u < fraction) in
+		place of fresh draws, shared between calls so that equal fractions share one Catalog (see compute_w_batch)
+	cache_max_gb: size limit of cache_dir, least-recently-used catalogues evicted beyond this
+	jk_labels: 4x integer arrays (or paths to label files), giving the jackknife region of every object
+		in dataf[0], dataf[1], randf[0], randf[1] (-1 = never deleted). Requires single_pass=1;
+		all delete-one signals are then built from per-region pair counts, and returned as a final
+		dict of (N_jk, nbins) arrays
+	random_seed: seed for the random_oversampling thinning of randoms -- default None = unseeded
+	thinning: 'random' = draw the thinned randoms from a (seeded) generator on each call,
+		'hash' = keep randoms by a seeded hash of their coordinates (hash_thinning), so the same
+		objects survive in every run & jackknife sample, and larger oversampling gives a superset
+	rr_store: directory of the PW2 RRs paircount store (paircount_store), keyed by random catalogues,
+		thinning & binning, so that counts are reused between runs -- default None = always recount.
+		Only used if the thinning is reproducible (thinning='hash' or a random_seed)
+	rr_store_max_gb: size limit of rr_store, least-recently-used counts evicted beyond this
 	"""
 
 	assert estimator in ['PW1', 'PW2', 'AS', 'wgg'], "for IA: estimator must be 'PW1/2' (pair_weighted 1=RDs, 2=RRs norm) or 'AS' (average shear), for clustering: 'wgg'"
@@ -23,6 +52,17 @@ def compute_w(dataf, randf, config, estimator='PW1', compensated=1, nbins_rpar=3
 	random_oversampling = float(random_oversampling)
 	verbosity = int(verbosity)
 	largePi = int(largePi)
+	single_pass = int(single_pass)
+	max_pairs = float(max_pairs)
+	return_3d = int(return_3d)
+	if random_seed is not None:
+		random_seed = int(random_seed)
+	assert thinning in ['random', 'hash'], "thinning must be 'random' or 'hash'"
+	rng = np.random.RandomState(random_seed)
+	def thin(cat, f):
+		if thinning == 'hash':
+			return hash_thinning(cat, f, seed=(random_seed or 0))
+		return np.array(rng.rand(cat.ntot) < f, dtype=float)
 
 	if type(config) == str:
 		config = treecorr.read_config(config)
@@ -42,90 +82,170 @@ def compute_w(dataf, randf, config, estimator='PW1', compensated=1, nbins_rpar=3
 
 	if estimator in ['PW1', 'PW2', 'AS']:
 		corr = 'ng'
-		gt_3D = np.zeros([len(Pi)-1, config['nbins']])
-		gx_3D = np.zeros([len(Pi)-1, config['nbins']])
-		varg_3D = np.zeros([len(Pi)-1, config['nbins']])
-		npair_3D = np.zeros([len(Pi)-1, config['nbins']])
 	elif estimator == 'wgg':
 		corr = 'nn'
-		wgg_3D = np.zeros([len(Pi)-1, config['nbins']])
 	else:
 		raise ValueError, "unsupported estimator choice"
 
 	config_r = config.copy()
 	config_r['flip_g1'] = False
 	config_r['flip_g2'] = False
-	data1 = treecorr.Catalog(dataf[0], config) # 1 = density/lenses
-	data2 = treecorr.Catalog(dataf[1], config) # 2 = shapes
-	rand1 = treecorr.Catalog(randf[0], config_r, is_rand=1)
-	rand2 = treecorr.Catalog(randf[1], config_r, is_rand=1)
-	f1 = data1.ntot * random_oversampling / float(rand1.ntot)
-	f2 = data2.ntot * random_oversampling / float(rand2.ntot)
-	rand1.w = np.array(np.random.rand(rand1.ntot) < f1, dtype=float)
-	rand2.w = np.array(np.random.rand(rand2.ntot) < f2, dtype=float)
+	if (catalogs is None) & (cache_dir is not None):
+		catalogs = catalog_cache.get_cache(cache_dir, max_gb=cache_max_gb)
+	if catalogs is None:
+		data1 = catalog_io.treecorr_catalog(dataf[0], config) # 1 = density/lenses
+		data2 = catalog_io.treecorr_catalog(dataf[1], config) # 2 = shapes
+		rand1 = catalog_io.treecorr_catalog(randf[0], config_r, is_rand=1)
+		rand2 = catalog_io.treecorr_catalog(randf[1], config_r, is_rand=1)
+		f1 = data1.ntot * random_oversampling / float(rand1.ntot)
+		f2 = data2.ntot * random_oversampling / float(rand2.ntot)
+		rand1.w = thin(rand1, f1)
+		rand2.w = thin(rand2, f2)
+	else:
+		# weights are fixed at construction for cached catalogues, never reassigned
+		cache = catalogs
+		data1 = cache.get(dataf[0], config)
+		data2 = cache.get(dataf[1], config)
+		nr1, nr2 = catalog_io.count(randf[0]), catalog_io.count(randf[1])
+		f1 = data1.ntot * random_oversampling / float(nr1)
+		f2 = data2.ntot * random_oversampling / float(nr2)
+		# randomly-thinned weights are fresh each call, so those randoms are built from the cached
+		# columns without holding the Catalogs in memory; hash-thinned/shared-draw ones recur, so are held
+		memo = int((thinning == 'hash') | (random_draws is not None))
+		def thin_cached(path, n, f, u):
+			if u is not None:
+				return np.array(u < f, dtype=float)
+			if thinning == 'hash':
+				return thin(cache.get(path, config_r, is_rand=1), f)
+			return np.array(rng.rand(n) < f, dtype=float)
+		u1, u2 = random_draws or (None, None)
+		rand1 = cache.get(randf[0], config_r, is_rand=1, w=thin_cached(randf[0], nr1, f1, u1), memo=memo)
+		rand2 = cache.get(randf[1], config_r, is_rand=1, w=thin_cached(randf[1], nr2, f2, u2), memo=memo)
+	if masks is not None:
+		assert jk_labels is None, "give one of masks or jk_labels"
+		data1, data2, rand1, rand2 = [c if m is None else _subset(c, m) for c, m in zip([data1, data2, rand1, rand2], masks)]
 	varg = treecorr.calculateVarG(data2)
 
-	for p in tqdm(range(len(Pi)-1), ascii=True, desc='Correlating'):
+	if jk_labels is not None:
+		assert single_pass, "analytic jackknife (jk_labels) requires single_pass=1"
+		jk_labels = [np.loadtxt(l, dtype=int) if isinstance(l, str) else np.asarray(l, dtype=int) for l in jk_labels]
+		njk = max(l.max() for l in jk_labels) + 1
+		l_d1, l_d2, l_r1, l_r2 = jk_labels
+	else:
+		njk = 0
+		l_d1 = l_d2 = l_r1 = l_r2 = None
 
-		if largePi & any(abs(Pi[p:p+2]) < config['max_rpar']):
-			continue
+	# raw (un-normalised) pair sums per (Pi, r_p) bin
+	shape = (len(Pi)-1, config['nbins'])
+	use_Pi = np.ones(len(Pi)-1, dtype=bool)
+	if largePi:
+		use_Pi = ~np.array([any(abs(Pi[p:p+2]) < config['max_rpar']) for p in range(len(Pi)-1)])
 
-		conf_pi = config.copy()
-		conf_pi['min_rpar'] = Pi[p]
-		conf_pi['max_rpar'] = Pi[p+1]
+	RRs, rrs, save_RRs = None, None, 0
+	if (estimator == 'PW2') & (rr_store is not None) & (thinning == 'random') & (random_seed is None):
+		warnings.warn("rr_store ignored: unseeded random thinning gives new RRs every call -- set random_seed or thinning=hash")
+	elif (estimator == 'PW2') & (rr_store is not None):
+		store = paircount_store.PairCountStore(rr_store, max_bytes=float(rr_store_max_gb) * 1e9)
+		rr_meta = paircount_store.rr_meta(randf, [rand1, rand2], config, Pi, random_oversampling, random_seed=random_seed,
+											method=('treecorr', 'single_pass')[single_pass], labels=(None, (l_r1, l_r2))[njk > 0])
+		rr_key = store.key(rr_meta)
+		stored = store.get(rr_key)
+		if stored is not None:
+			RRs = stored['weight']
+			if njk:
+				rrs = {'jk': {'weight': stored['jk_weight']}}
+			if verbosity:
+				print('read RRs paircounts from store: %s' % store.entry(rr_key))
+		else:
+			save_RRs = 1
 
+	if single_pass:
+		# accumulate every (r_p, Pi) bin in one traversal of the catalogues
+		metric = config.get('metric', 'Rperp')
+		if metric not in ['Rperp', 'OldRperp']:
+			raise ValueError("single_pass supports metric = Rperp or OldRperp only, not %s" % metric)
+		if float(config.get('bin_slop', 1.)) != 0:
+			warnings.warn("single_pass counts pairs exactly -- bin_slop = %s is ignored" % config.get('bin_slop'))
+		rp_edges = np.logspace(np.log10(config['min_sep']), np.log10(config['max_sep']), config['nbins'] + 1)
+		r = np.exp(midpoints(np.log(rp_edges)))
 		if corr == 'ng':
-			ng = treecorr.NGCorrelation(conf_pi)
-			rg = treecorr.NGCorrelation(conf_pi)
-			ng.process_cross(data1, data2)
-			rg.process_cross(rand1, data2)
-
-			if estimator == 'PW1': # RDs norm
-				f = data1.ntot / rand1.w.sum()
-				norm1 = rg.weight * f
-				norm2 = rg.weight
-			if estimator == 'PW2': # RRs norm
-				RRs = get_RRs(rand1, rand2, conf_pi, **kwargs)
-				f1 = data1.ntot / rand1.w.sum()
-				f2 = data2.ntot / rand2.w.sum()
-				norm1 = RRs * f1 * f2
-				norm2 = RRs * f2
-			elif estimator == 'AS': # DDs norm
-				norm1 = ng.weight
-				norm2 = rg.weight
-
-			if int(compensated):
-				gt_3D[p] += (ng.xi / norm1) - (rg.xi / norm2)
-				gx_3D[p] += (ng.xi_im / norm1) - (rg.xi_im / norm2)
-				varg_3D[p] += (varg / norm1) + (varg / norm2)
-				npair_3D[p] += ng.npairs
-			else:
-				gt_3D[p] += ng.xi / norm1
-				gx_3D[p] += ng.xi_im / norm1
-				varg_3D[p] += varg / norm1
-				npair_3D[p] += ng.npairs
-
+			ng = count_pairs_3d(data1, data2, rp_edges, Pi, shear=1, labels=(l_d1, l_d2), njk=njk, max_pairs=max_pairs, metric=metric)
+			rg = count_pairs_3d(rand1, data2, rp_edges, Pi, shear=1, labels=(l_r1, l_d2), njk=njk, max_pairs=max_pairs, metric=metric)
+			if (estimator == 'PW2') & (RRs is None):
+				rrs = count_pairs_3d(rand1, rand2, rp_edges, Pi, labels=(l_r1, l_r2), njk=njk, max_pairs=max_pairs, metric=metric)
+				RRs = rrs['weight']
 		elif corr == 'nn':
-			nn = treecorr.NNCorrelation(conf_pi)
-			rr = treecorr.NNCorrelation(conf_pi)
-			nr = treecorr.NNCorrelation(conf_pi)
-			rn = treecorr.NNCorrelation(conf_pi)
-
 			if dataf[0] == dataf[1]:
-				nn.process(data1)
-				rr.process(rand1)
-				nr.process(data1, rand1)
-				xi, varxi = nn.calculateXi(rr, nr)
+				nn = count_pairs_3d(data1, data1, rp_edges, Pi, labels=(l_d1, l_d1), njk=njk, max_pairs=max_pairs, metric=metric)
+				rr = count_pairs_3d(rand1, rand1, rp_edges, Pi, labels=(l_r1, l_r1), njk=njk, max_pairs=max_pairs, metric=metric)
+				nr = rn = count_pairs_3d(data1, rand1, rp_edges, Pi, labels=(l_d1, l_r1), njk=njk, max_pairs=max_pairs, metric=metric)
 			else:
-				nn.process(data1, data2)
-				rr.process(rand1, rand2)
-				nr.process(data1, rand2)
-				rn.process(rand1, data2)
-				xi, varxi = nn.calculateXi(rr, nr, rn)
+				nn = count_pairs_3d(data1, data2, rp_edges, Pi, labels=(l_d1, l_d2), njk=njk, max_pairs=max_pairs, metric=metric)
+				rr = count_pairs_3d(rand1, rand2, rp_edges, Pi, labels=(l_r1, l_r2), njk=njk, max_pairs=max_pairs, metric=metric)
+				nr = count_pairs_3d(data1, rand2, rp_edges, Pi, labels=(l_d1, l_r2), njk=njk, max_pairs=max_pairs, metric=metric)
+				rn = count_pairs_3d(rand1, data2, rp_edges, Pi, labels=(l_r1, l_d2), njk=njk, max_pairs=max_pairs, metric=metric)
+	else:
+		if corr == 'ng':
+			ng = dict((k, np.zeros(shape)) for k in ['xi', 'xi_im', 'weight', 'npairs'])
+			rg = dict((k, np.zeros(shape)) for k in ['xi', 'xi_im', 'weight', 'npairs'])
+			count_RRs = (estimator == 'PW2') & (RRs is None)
+			if count_RRs:
+				RRs = np.zeros(shape)
+		elif corr == 'nn':
+			wgg_3D = np.zeros(shape)
+
+		for p in tqdm(range(len(Pi)-1), ascii=True, desc='Correlating'):
+
+			if not use_Pi[p]:
+				continue
+
+			conf_pi = config.copy()
+			conf_pi['min_rpar'] = Pi[p]
+			conf_pi['max_rpar'] = Pi[p+1]
+
+			if corr == 'ng':
+				ng_p = treecorr.NGCorrelation(conf_pi)
+				rg_p = treecorr.NGCorrelation(conf_pi)
+				ng_p.process_cross(data1, data2)
+				rg_p.process_cross(rand1, data2)
+				for k in ng.keys():
+					ng[k][p] = getattr(ng_p, k)
+					rg[k][p] = getattr(rg_p, k)
+				if count_RRs:
+					RRs[p] = get_RRs(rand1, rand2, conf_pi)
+				r = ng_p.rnom
 
-			wgg_3D[p] += xi
+			elif corr == 'nn':
+				nn_p = treecorr.NNCorrelation(conf_pi)
+				rr_p = treecorr.NNCorrelation(conf_pi)
+				nr_p = treecorr.NNCorrelation(conf_pi)
+				rn_p = treecorr.NNCorrelation(conf_pi)
+
+				if dataf[0] == dataf[1]:
+					nn_p.process(data1)
+					rr_p.process(rand1)
+					nr_p.process(data1, rand1)
+					xi, varxi = nn_p.calculateXi(rr_p, nr_p)
+				else:
+					nn_p.process(data1, data2)
+					rr_p.process(rand1, rand2)
+					nr_p.process(data1, rand2)
+					rn_p.process(rand1, data2)
+					xi, varxi = nn_p.calculateXi(rr_p, nr_p, rn_p)
+
+				wgg_3D[p] += xi
+				r = nn_p.rnom
+
+	if save_RRs:
+		# one write per measurement, covering every Pi-slice
+		rr_counts = {'weight': RRs}
+		if njk:
+			rr_counts['jk_weight'] = rrs['jk']['weight']
+		store.put(rr_key, rr_counts, rr_meta, randoms=[os.path.abspath(f) for f in randf])
 
 	if corr == 'ng':
+		gt_3D, gx_3D, varg_3D, npair_3D = ng_estimator(ng, rg, RRs, data1.ntot, rand1.w.sum(), data2.ntot, rand2.w.sum(),
+														varg, estimator=estimator, compensated=compensated, use_Pi=use_Pi)
 		#gt = np.trapz(gt_3D, x=midpoints(Pi), axis=0)
 		#gx = np.trapz(gx_3D, x=midpoints(Pi), axis=0)
 		#gt = simps(gt_3D, x=midpoints(Pi), axis=0)
@@ -133,35 +253,273 @@ def compute_w(dataf, randf, config, estimator='PW1', compensated=1, nbins_rpar=3
 		gx = np.sum(gx_3D * (Pi[1] - Pi[0]), axis=0)
 		varg = np.sum(varg_3D, axis=0)
 		npair = np.sum(npair_3D, axis=0)
-		r = ng.rnom
-		return r, gt, gx, varg**0.5, npair
+		out = [r, gt, gx, varg**0.5, npair]
+		if return_3d:
+			out.append((Pi, gt_3D, gx_3D, npair_3D))
+		if njk:
+			# delete-one signals by subtraction of per-region counts
+			n_d1, n_d2 = _delete_one(l_d1, np.ones(data1.ntot), njk), _delete_one(l_d2, np.ones(data2.ntot), njk)
+			n_r1, n_r2 = _delete_one(l_r1, _cat_w(rand1), njk), _delete_one(l_r2, _cat_w(rand2), njk)
+			jk = {'gt': np.zeros([njk, len(r)]), 'gx': np.zeros([njk, len(r)])}
+			for k in range(njk):
+				RRs_k = None if RRs is None else rrs['jk']['weight'][k]
+				gt_k, gx_k = ng_estimator(_region(ng, k), _region(rg, k), RRs_k, n_d1[k], n_r1[k], n_d2[k], n_r2[k],
+										varg, estimator=estimator, compensated=compensated, use_Pi=use_Pi)[:2]
+				jk['gt'][k] = np.sum(gt_k * (Pi[1] - Pi[0]), axis=0)
+				jk['gx'][k] = np.sum(gx_k * (Pi[1] - Pi[0]), axis=0)
+			out.append(jk)
+		return tuple(out)
 	elif corr == 'nn':
+		if single_pass:
+			wgg_3D = nn_estimator(nn, rr, nr, rn, use_Pi=use_Pi)
 		wgg = np.sum(wgg_3D * (Pi[1] - Pi[0]), axis=0)
-		r = nn.rnom
-		return r, wgg
-
-def get_RRs(R_cat, Rs_cat, config, load_RRs=None, save_RRs=None, **kwargs):
-	minmax = (config['min_rpar'], config['max_rpar'])
-
-	if load_RRs is not None:
-		# read paircounts from pickle file
-		RRs_dict = pickle.load(open(load_RRs, 'r'))
-		rrs_weight = RRs_dict[minmax]
-		assert len(rrs_weight) == config['nbins'], "RRs pairs from file do not match specified transverse binning"
-		return rrs_weight
+		out = [r, wgg]
+		if return_3d:
+			out.append((Pi, wgg_3D))
+		if njk:
+			jk = {'wgg': np.array([np.sum(nn_estimator(_region(nn, k), _region(rr, k), _region(nr, k), _region(rn, k), use_Pi=use_Pi)
+												* (Pi[1] - Pi[0]), axis=0) for k in range(njk)])}
+			out.append(jk)
+		return tuple(out)
+
+def compute_w_batch(jobs, config, nproc=1, thinning='random', random_oversampling=10., cache_dir=None, cache_max_gb=20., **kwargs):
+	"""
+	run compute_w for several samples in one process, sharing catalogues between them
+	jobs: list of (dataf, randf) pairs, as for compute_w
+	config: TreeCorr config, as for compute_w -- num_threads is split between concurrent jobs
+	nproc: total number of threads; jobs are run concurrently on min(nproc, len(jobs)) threads
+	each file is parsed once and shared by every job using it; randoms are thinned per job to its own
+	random_oversampling, by nested cuts of one uniform draw per object & file (thinning='random',
+	seeded by random_seed) or of the coordinate hash (thinning='hash') -- so jobs thinning a file
+	to the same fraction share one random Catalog & tree
+	returns list of compute_w outputs, in the order of jobs
+	"""
+	from multiprocessing.pool import ThreadPool
+	nproc = int(nproc)
+	if type(config) == str:
+		config = treecorr.read_config(config)
+	if cache_dir is not None:
+		catalogs = catalog_cache.get_cache(cache_dir, max_gb=cache_max_gb)
 	else:
-		# compute paircounts and create pickle file
-		rrs = treecorr.NNCorrelation(config)
-		rrs.process_cross(R_cat, Rs_cat)
-		if save_RRs is not None:
-			try:
-				RRs_dict = pickle.load(open(save_RRs, 'r'))
-			except IOError:
-				RRs_dict = {}
-			RRs_dict[minmax] = rrs.weight
-			pickle.dump(RRs_dict, open(save_RRs, 'w'))
-		return rrs.weight
+		catalogs = catalog_cache.CatalogCache(None)
+	catalogs.max_memory = max(catalogs.max_memory, 4 * len(jobs))
+
+	# parse every file once
+	config_r = config.copy()
+	config_r['flip_g1'] = False
+	config_r['flip_g2'] = False
+	draws = {}
+	rng = np.random.RandomState(None if kwargs.get('random_seed') is None else int(kwargs['random_seed']))
+	for dataf, randf in jobs:
+		for df, rf in zip(dataf, randf):
+			catalogs.get(df, config)
+			catalogs.get(rf, config_r, is_rand=1, memo=int(thinning == 'hash'))
+			if (thinning == 'random') & (rf not in draws):
+				draws[rf] = rng.rand(catalog_io.count(rf))
 
+	nworkers = max(1, min(nproc, len(jobs)))
+	conf = config.copy()
+	conf['num_threads'] = max(1, nproc // nworkers)
+	def run(job):
+		dataf, randf = job
+		random_draws = (draws[randf[0]], draws[randf[1]]) if draws else None
+		return compute_w(dataf, randf, conf.copy(), thinning=thinning, random_oversampling=random_oversampling,
+						catalogs=catalogs, random_draws=random_draws, **kwargs)
+	pool = ThreadPool(nworkers)
+	try:
+		return pool.map(run, jobs)
+	finally:
+		pool.close()
+
+def ng_estimator(ng, rg, RRs, n1, nr1, n2, nr2, varg, estimator='PW1', compensated=1, use_Pi=None):
+	"""
+	Pi-resolved g+/x signals from raw NG pair sums (dicts of 'xi', 'xi_im', 'weight', 'npairs' grids),
+	RRs weights (PW2 only), data counts n1/n2 & total random weights nr1/nr2
+	returns gt_3D, gx_3D, varg_3D, npair_3D; rows outside use_Pi are left as zeros
+	"""
+	shape = ng['weight'].shape
+	u = np.ones(shape[0], dtype=bool) if use_Pi is None else use_Pi
+	gt_3D, gx_3D, varg_3D, npair_3D = [np.zeros(shape) for i in range(4)]
+
+	if estimator == 'PW1': # RDs norm
+		f = n1 / nr1
+		norm1 = rg['weight'][u] * f
+		norm2 = rg['weight'][u]
+	elif estimator == 'PW2': # RRs norm
+		f1 = n1 / nr1
+		f2 = n2 / nr2
+		norm1 = RRs[u] * f1 * f2
+		norm2 = RRs[u] * f2
+	elif estimator == 'AS': # DDs norm
+		norm1 = ng['weight'][u]
+		norm2 = rg['weight'][u]
+
+	if int(compensated):
+		gt_3D[u] += (ng['xi'][u] / norm1) - (rg['xi'][u] / norm2)
+		gx_3D[u] += (ng['xi_im'][u] / norm1) - (rg['xi_im'][u] / norm2)
+		varg_3D[u] += (varg / norm1) + (varg / norm2)
+		npair_3D[u] += ng['npairs'][u]
+	else:
+		gt_3D[u] += ng['xi'][u] / norm1
+		gx_3D[u] += ng['xi_im'][u] / norm1
+		varg_3D[u] += varg / norm1
+		npair_3D[u] += ng['npairs'][u]
+	return gt_3D, gx_3D, varg_3D, npair_3D
+
+def nn_estimator(nn, rr, nr, rn, use_Pi=None):
+	# Landy-Szalay wgg(Pi, r_p) from raw pair weights, normalised by total pair weights
+	shape = nn['weight'].shape
+	u = np.ones(shape[0], dtype=bool) if use_Pi is None else use_Pi
+	wgg_3D = np.zeros(shape)
+	rrn = rr['weight'][u] / rr['tot']
+	wgg_3D[u] = (nn['weight'][u] / nn['tot'] - nr['weight'][u] / nr['tot'] - rn['weight'][u] / rn['tot'] + rrn) / rrn
+	return wgg_3D
+
+def _region(counts, k):
+	# delete-one (region k) pair counts from count_pairs_3d output
+	return dict((q, v[k]) for q, v in counts['jk'].items())
+
+def _delete_one(labels, w, njk):
+	# total weight remaining after deleting each region in turn
+	lab = labels >= 0
+	return w.sum() - np.bincount(labels[lab], weights=w[lab], minlength=njk)
+
+def _cat_xyz(cat):
+	# cartesian positions [Mpc/h] from TreeCorr ra/dec [rad] & r columns
+	cosdec = np.cos(cat.dec)
+	return np.column_stack((cosdec * np.cos(cat.ra), cosdec * np.sin(cat.ra), np.sin(cat.dec))) * cat.r[:, None]
+
+def _subset(cat, mask):
+	# Catalog of the objects selected by boolean mask
+	mask = np.asarray(mask, dtype=bool)
+	kw = dict((k, getattr(cat, k)[mask]) for k in ['ra', 'dec', 'r', 'g1', 'g2', 'w'] if getattr(cat, k) is not None)
+	return treecorr.Catalog(ra_units='radians', dec_units='radians', **kw)
+
+def _cat_w(cat):
+	if cat.w is None:
+		return np.ones(cat.ntot)
+	return np.asarray(cat.w, dtype=float)
+
+def _mix64(x):
+	# splitmix64 finaliser, vectorised over uint64 arrays
+	x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+	x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+	return x ^ (x >> np.uint64(31))
+
+def hash_thinning(cat, f, seed=0):
+	# keep objects with uniform(hash(seed, ra, dec, r)) < f; deterministic, and independent of row
+	# order/deletions, so every jackknife sample keeps the same subset of the randoms it shares
+	with np.errstate(over='ignore'):
+		h = np.zeros(cat.ntot, dtype=np.uint64) + np.uint64(seed) * np.uint64(0x9e3779b97f4a7c15)
+		for col in [cat.ra, cat.dec, cat.r]:
+			if col is not None:
+				h = _mix64(h ^ np.ascontiguousarray(col, dtype=np.float64).view(np.uint64))
+	u = (h >> np.uint64(11)).astype(np.float64) / 2.**53
+	return np.array(u < f, dtype=float)
+
+def _cat_tree(cat):
+	# KD-tree of non-zero-weight objects, kept on the catalogue for reuse between calls
+	tree = getattr(cat, '_kdtree', None)
+	if tree is None:
+		from scipy.spatial import cKDTree
+		idx = np.where(_cat_w(cat) != 0)[0]
+		tree = cat._kdtree = (cKDTree(_cat_xyz(cat)[idx]), idx)
+	return tree
+
+def project_shear(ra1, dec1, ra2, dec2, g1, g2):
+	# tangential & cross components of shears (2) about positions (1),
+	# projected in the local (east, north) frame of each shape galaxy
+	dra = ra1 - ra2
+	east = np.cos(dec1) * np.sin(dra)
+	north = np.cos(dec2) * np.sin(dec1) - np.sin(dec2) * np.cos(dec1) * np.cos(dra)
+	norm = east**2 + north**2
+	cos2 = (east**2 - north**2) / norm
+	sin2 = 2. * east * north / norm
+	gt = -(g1 * cos2 + g2 * sin2)
+	gx = -(g2 * cos2 - g1 * sin2)
+	return gt, gx
+
+def count_pairs_3d(cat1, cat2, rp_edges, Pi_edges, shear=0, labels=None, njk=0, chunk_size=50000, max_pairs=2e7, metric='Rperp'):
+	"""
+	Count pairs between TreeCorr catalogues cat1 (positions) & cat2 (positions
+	or shapes) in all (Pi, r_p) bins at once, with r_p^2 = |x2 - x1|^2 - r_par^2 and r_par as
+	the TreeCorr metric: 'Rperp' = (x2 - x1) projected onto the pair's mean line of sight
+	(x1 + x2)/2, or 'OldRperp' = r2 - r1. Pairs are found exactly (as bin_slop=0),
+	chunking over cat1 against a single KD-tree of cat2, with chunks split further so that
+	no more than ~max_pairs pairs are held in memory at once.
+
+	returns dict of (len(Pi_edges)-1, len(rp_edges)-1) grids: 'npairs', 'weight',
+	and if shear: 'xi', 'xi_im' (raw sums of w1*w2*g_t/x, as NGCorrelation.process_cross)
+	plus 'tot' = sum(w1)*sum(w2)
+
+	labels: optional (labels1, labels2) jackknife-region integer arrays (-1 = no region) for
+	njk regions; counts['jk'] then holds every quantity above with region k deleted, as
+	(njk, ...) arrays, built as total - (pairs with either member in region k)
+	"""
+	from scipy.spatial import cKDTree
+	x1 = _cat_xyz(cat1)
+	x2 = _cat_xyz(cat2) if metric == 'Rperp' else None
+	w1, w2 = _cat_w(cat1), _cat_w(cat2)
+	nPi, nrp = len(Pi_edges) - 1, len(rp_edges) - 1
+	size = nPi * nrp
+	Pi_max = max(abs(Pi_edges[0]), abs(Pi_edges[-1]))
+	rmax = np.sqrt(rp_edges[-1]**2 + Pi_max**2)
+
+	sums = dict((k, np.zeros(size)) for k in ['npairs', 'weight'] + ['xi', 'xi_im'] * int(bool(shear)))
+	tree2, idx2 = _cat_tree(cat2)
+	do_jk = (labels is not None) and (labels[0] is not None) and njk
+	if do_jk:
+		l1, l2 = [np.asarray(l, dtype=int) for l in labels]
+		touch = dict((k, np.zeros(njk * size)) for k in sums.keys())
+	for start in range(0, len(x1), chunk_size):
+		i1 = np.arange(start, min(start + chunk_size, len(x1)))
+		i1 = i1[w1[i1] != 0]
+		if len(i1) == 0:
+			continue
+		# split the chunk by its neighbour counts, so each sub-chunk holds <~ max_pairs pairs
+		nnb = tree2.query_ball_point(x1[i1], rmax, return_length=True)
+		before = np.cumsum(nnb) - nnb
+		group = np.asarray(before // max_pairs, dtype=int)
+		for i1 in np.split(i1, np.where(np.diff(group))[0] + 1):
+			pairs = cKDTree(x1[i1]).sparse_distance_matrix(tree2, rmax, output_type='ndarray')
+			i, j = i1[pairs['i']], idx2[pairs['j']]
+			if metric == 'Rperp':
+				L = x1[i] + x2[j]
+				rpar = np.einsum('ij,ij->i', x2[j] - x1[i], L) / np.sqrt(np.einsum('ij,ij->i', L, L))
+			else:
+				rpar = cat2.r[j] - cat1.r[i]
+			rperp = np.sqrt(np.maximum(pairs['v']**2 - rpar**2, 0.))
+			ip = np.searchsorted(Pi_edges, rpar, side='right') - 1
+			ir = np.searchsorted(rp_edges, rperp, side='right') - 1
+			inbin = (ip >= 0) & (ip < nPi) & (ir >= 0) & (ir < nrp)
+			i, j = i[inbin], j[inbin]
+			b = ip[inbin] * nrp + ir[inbin]
+			ww = w1[i] * w2[j]
+			vals = {'npairs': None, 'weight': ww}
+			if shear:
+				gt, gx = project_shear(cat1.ra[i], cat1.dec[i], cat2.ra[j], cat2.dec[j], cat2.g1[j], cat2.g2[j])
+				vals['xi'], vals['xi_im'] = ww * gt, ww * gx
+			for q, v in vals.items():
+				sums[q] += np.bincount(b, weights=v, minlength=size)
 
+			if do_jk:
+				# pairs touching region k = (1 in k) + (2 in k) - (both in k)
+				a1, a2 = l1[i], l2[j]
+				for sel, a, sign in ((a1 >= 0, a1, 1.), (a2 >= 0, a2, 1.), ((a1 == a2) & (a1 >= 0), a1, -1.)):
+					ab = a[sel] * size + b[sel]
+					for q, v in vals.items():
+						touch[q] += sign * np.bincount(ab, weights=None if v is None else v[sel], minlength=njk * size)
+			del pairs, i, j, b, ww, vals
 
+	counts = dict((k, v.reshape(nPi, nrp)) for k, v in sums.items())
+	counts['tot'] = w1.sum() * w2.sum()
+	if do_jk:
+		counts['jk'] = dict((k, counts[k][None] - v.reshape(njk, nPi, nrp)) for k, v in touch.items())
+		counts['jk']['tot'] = _delete_one(l1, w1, njk) * _delete_one(l2, w2, njk)
+	return counts
 
+def get_RRs(R_cat, Rs_cat, config):
+	# RRs paircounts for one Pi-slice -- stored/reused via compute_w(rr_store=...)
+	rrs = treecorr.NNCorrelation(config)
+	rrs.process_cross(R_cat, Rs_cat)
+	return rrs.weight
@@ -1,15 +1,10 @@
 from __future__ import print_function,division
 import numpy as np
 import gc
-from astropy.cosmology import FlatLambdaCDM as FLCDM
-MICEcosmo = FLCDM(Om0=0.25, H0=70, Ob0=0.044)
+from distances import get_distances
 import scipy.integrate as scint
 import operator
 
-def fivept_stencil(func, x, h):
-    # returns f'(x), via 5pt stencil, for grid-spacing h
-    return (-func(x+2*h)+8*func(x+h)-8*func(x-h)+func(x-2*h))/(12*h)
-
 def compute_Wz(z, nofz_s, nofz_d, eta, beta, Rmag, wgg=0):
     # Wz = [p^2 / X^2*X'] / int[p^2 / X^2*X' dz]
 
@@ -20,13 +15,13 @@ def compute_Wz(z, nofz_s, nofz_d, eta, beta, Rmag, wgg=0):
     assert pz_d.shape==z.shape, "p(z) vs. z mismatch"
 
     # compute X(z) = comoving coordiante
-    MICEcomov = lambda x: MICEcosmo.comoving_distance(x) # h (hubble parameter) cancels
-    Xz = MICEcomov(z)
+    MICEdist = get_distances() # h (hubble parameter) cancels
+    Xz = MICEdist.chi(z)
     Xz2 = Xz**2
 
-    # compute X'(z) = first deriv.
+    # compute X'(z) = first deriv., from the spline
     h = z[1]-z[0]
-    Xprime = fivept_stencil(MICEcomov,z,h)
+    Xprime = MICEdist.dchi_dz(z)
 
     # combine & integrate (Riemann sum) over z
     Wz_nom = (pz_s*pz_d)/(Xz2*Xprime)
@@ -39,7 +34,7 @@ def compute_Wz(z, nofz_s, nofz_d, eta, beta, Rmag, wgg=0):
     if not wgg:
         Wz_scaled *= zfactor*Lfactor
 
-    del pz_d, pz_s, MICEcomov, Xz, Xz2, Xprime, Wz_nom
+    del pz_d, pz_s, Xz, Xz2, Xprime, Wz_nom
     gc.collect()
 
     return Wz,Wz_scaled